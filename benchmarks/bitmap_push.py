@@ -0,0 +1,87 @@
+# compare push enumeration (base.iter_objects_in_commits) with and without
+# reachability bitmaps on a synthetic history.
+#
+#   python benchmarks/bitmap_push.py [--commits 2000] [--files 200]
+#
+# it builds a throwaway repo in a temp dir, runs `repack -a -b`, makes one
+# more commit, then times:
+#   - incremental push: the new commit, the remote already has the old tip
+#   - full push: everything, to an empty remote
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from src import data, base # noqa: E402
+
+
+def make_history(commit_count: int, file_count: int) -> None:
+    base.init()
+    paths = [os.path.join(f"dir{i % 20}", f"file{i}.txt") for i in range(file_count)]
+    for path in paths:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as file:
+            file.write(f"{path}\n")
+    base.add(paths)
+    base.commit("initial")
+
+    rand = random.Random(0)
+    for i in range(commit_count - 1):
+        path = rand.choice(paths)
+        with open(path, "a") as file:
+            file.write(f"change {i}\n")
+        base.add([path])
+        base.commit(f"change {i}")
+
+
+def time_enumeration(want: str, have: str | None, use_bitmaps: bool, rounds: int) -> tuple[float, int]:
+    best = float("inf")
+    count = 0
+    for _ in range(rounds):
+        data.parsed_objects.clear() # every round starts cold
+        start = time.perf_counter()
+        count = sum(1 for _ in base.iter_objects_in_commits({want}, [have] if have else [], use_bitmaps))
+        best = min(best, time.perf_counter() - start)
+    return (best, count)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--commits", type=int, default=2000)
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as repo_dir:
+        os.chdir(repo_dir)
+        with data.switch_rgit_dir("."):
+            start = time.perf_counter()
+            make_history(args.commits, args.files)
+            print(f"built {args.commits} commits in {time.perf_counter() - start:.1f}s")
+
+            packed = data.repack(all_objects=True)
+            assert packed is not None, "nothing to repack"
+            name, object_count, _ = packed
+            start = time.perf_counter()
+            bitmap_count = base.write_bitmaps(name)
+            print(f"{object_count} objects, wrote {bitmap_count} bitmaps in {time.perf_counter() - start:.2f}s")
+
+            old_tip = base.get_oid("HEAD")
+            with open(os.path.join("dir0", "file0.txt"), "a") as file:
+                file.write("one more\n")
+            base.add([os.path.join("dir0", "file0.txt")])
+            new_tip = base.commit("one more")
+
+            for label, have in (("incremental push", old_tip), ("full push", None)):
+                walk_time, walk_count = time_enumeration(new_tip, have, False, args.rounds)
+                bitmap_time, bitmap_count = time_enumeration(new_tip, have, True, args.rounds)
+                assert walk_count == bitmap_count, f"{label}: {walk_count} != {bitmap_count} objects"
+                print(f"{label}: {walk_count} objects, tree walk {walk_time * 1000:.1f}ms, "
+                    f"bitmaps {bitmap_time * 1000:.1f}ms ({walk_time / bitmap_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
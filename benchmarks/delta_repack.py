@@ -0,0 +1,73 @@
+# compare the pack `repack -a` writes with and without path hints on a
+# synthetic history where a few files change a little in every commit.
+#
+#   python benchmarks/delta_repack.py [--commits 300] [--files 20]
+#
+# it also checks that data.repack hands the tree paths it was given to
+# pack.write_pack (they group the versions of one file for delta search)
+import os
+import sys
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from src import data, base, pack # noqa: E402
+
+
+def make_history(commit_count: int, file_count: int) -> None:
+    base.init()
+    paths = [os.path.join(f"dir{i % 5}", f"file{i}.txt") for i in range(file_count)]
+    rand = random.Random(0)
+    for path in paths:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as file:
+            file.writelines(f"{path} line {n} {rand.random()}\n" for n in range(50))
+    base.add(paths)
+    base.commit("initial")
+
+    for i in range(commit_count - 1):
+        path = rand.choice(paths)
+        with open(path, "a") as file:
+            file.write(f"change {i}\n")
+        base.add([path])
+        base.commit(f"change {i}")
+
+
+def repack_size(paths: dict[str, str] | None) -> tuple[int, int]:
+    seen_paths = []
+    write_pack = pack.write_pack
+
+    def spy(*args, **kwargs):
+        seen_paths.append(kwargs.get("paths"))
+        return write_pack(*args, **kwargs)
+
+    pack.write_pack = spy
+    try:
+        result = data.repack(all_objects=True, paths=paths)
+    finally:
+        pack.write_pack = write_pack
+    assert result is not None
+    assert seen_paths == [paths], "repack didn't pass its path hints to write_pack"
+
+    name, count, _ = result
+    return (os.path.getsize(os.path.join(data.RGIT_DIR, "objects", "pack", f"{name}.pack")), count)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--commits", type=int, default=300)
+    parser.add_argument("--files", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as repo_dir:
+        os.chdir(repo_dir)
+        with data.switch_rgit_dir("."):
+            make_history(args.commits, args.files)
+            for label, paths in (("no hints", None), ("tree paths", base.get_object_paths())):
+                size, count = repack_size(paths)
+                print(f"{label}: {count} objects, {size} bytes")
+
+
+if __name__ == "__main__":
+    main()
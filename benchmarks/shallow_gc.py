@@ -0,0 +1,64 @@
+# check that deepening a shallow clone that has reachability bitmaps can't
+# make gc delete reachable objects:
+#
+#   python benchmarks/shallow_gc.py [--commits 10]
+#
+# fetch --depth 2, repack -a -b, fetch --depth 6, gc --expire 0, then every
+# object reachable from the fetched branch must still be readable
+import os
+import sys
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from src import data, base, remote # noqa: E402
+
+
+def make_history(commit_count: int) -> None:
+    base.init()
+    for i in range(commit_count):
+        with open(f"file{i}.txt", "w") as file:
+            file.write(f"version {i}\n")
+        with open("common.txt", "a") as file:
+            file.write(f"change {i}\n")
+        base.add([f"file{i}.txt", "common.txt"])
+        base.commit(f"change {i}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--commits", type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        source_dir = os.path.join(temp_dir, "source")
+        clone_dir = os.path.join(temp_dir, "clone")
+        os.makedirs(source_dir)
+        os.makedirs(clone_dir)
+
+        os.chdir(source_dir)
+        with data.switch_rgit_dir("."):
+            make_history(args.commits)
+
+        os.chdir(clone_dir)
+        with data.switch_rgit_dir("."):
+            base.init()
+            remote.fetch(source_dir, depth=2)
+            packed = data.repack(all_objects=True)
+            assert packed is not None, "nothing to repack"
+            bitmap_count = base.write_bitmaps(packed[0])
+            remote.fetch(source_dir, depth=6)
+            result = base.gc(expire_seconds=0)
+            print(f"{bitmap_count} bitmaps before deepening, gc pruned {result.pruned} objects")
+
+            tip = base.get_oid("refs/remote/master")
+            reachable = list(base.iter_objects_in_commits({tip}, use_bitmaps=False))
+            missing = [oid for oid in reachable if not data.object_exists(oid)]
+            assert not missing, f"gc deleted {len(missing)} reachable objects, e.g. {missing[0]}"
+            history = list(base.iter_commits_and_parents({tip}))
+            assert len(history) == 6, f"expected 6 commits after deepening, got {len(history)}"
+            print(f"ok: {len(reachable)} reachable objects, {len(history)} commits")
+
+
+if __name__ == "__main__":
+    main()
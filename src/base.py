@@ -1,10 +1,13 @@
 # base module provide higher level implementation of data.py
 import os
+import time
+import heapq
 import itertools
 import string
-from src import data, diff
-from typing import Dict, Iterator, Tuple, Union, cast
+from src import data, diff, graph, bitmap, pack, ignore
+from typing import Dict, Iterable, Iterator, Tuple, Union, cast
 from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 
@@ -26,18 +29,23 @@ def init() -> None:
 # ...
 # of the files object inside
 def write_tree() -> str:
-    tree_dict: NestedDict = {} # a dict that nested like tree
     with data.get_index() as index:
-        for path, oid in index.items():
-            file_name = os.path.basename(path)
-            dir_name = os.path.dirname(path)
-            traverse_list = Path(dir_name).parts
-
-            cur = tree_dict
-            for dir in traverse_list:
-                # have to explicitly cast to NestedDict to avoid mypy error
-                cur = cast(NestedDict, cur.setdefault(dir, {}))
-            cur[file_name] = oid
+        return _write_tree_from_paths({path: entry.oid for path, entry in index.items()})
+
+
+# write tree objects for a flat path -> oid tree, return the root tree oid
+def _write_tree_from_paths(tree: Tree) -> str:
+    tree_dict: NestedDict = {} # a dict that nested like tree
+    for path, oid in tree.items():
+        file_name = os.path.basename(path)
+        dir_name = os.path.dirname(path)
+        traverse_list = Path(dir_name).parts
+
+        cur = tree_dict
+        for dir in traverse_list:
+            # have to explicitly cast to NestedDict to avoid mypy error
+            cur = cast(NestedDict, cur.setdefault(dir, {}))
+        cur[file_name] = oid
     """
     Goal: receive dict tree -> return tree oid
     0. have tree content waiting
@@ -60,27 +68,16 @@ def write_tree() -> str:
                 type_ = "tree"
                 oid = write_tree_from_dict(value)
             tree_entries.append((type_, oid, name))
-            tree_content = "".join(f"{type_} {oid} {name}\n"
-                for type_, oid, name in sorted(tree_entries))
-        tree_oid = data.hash_object(tree_content.encode(), type_="tree")
+        tree_oid = data.hash_object(data.format_tree(tree_entries), type_="tree")
         return tree_oid
     return write_tree_from_dict(tree_dict)
 
 
-# now we will only ignore the .rgit (and .git since it's annoying) dir
-def is_ignored(path: str) -> bool:
-    return ".rgit" in path.split("/") or ".git" in path.split("/")
-
-
 # get tree oid -> go get each child in tree object and yield as tuple (type, oid, name)
 def _iter_tree_entries(oid: str) -> Iterator[Tuple[str, str, str]]:
     if not oid:
         return
-    tree_content_bytes = data.get_object_content(oid, expected="tree")
-    tree_content_lines = tree_content_bytes.decode().splitlines()
-    for line in tree_content_lines:
-        type_, oid, name = line.split(" ", 2)
-        yield (type_, oid, name)
+    yield from data.get_tree_entries(oid)
 
 
 # get oid and opt base_path, put every blob inside the tree to dict: path -> oid
@@ -102,57 +99,84 @@ def get_tree(oid: str, base_path: str = "") -> Tree:
 # get the oid of a tree, then update index
 # and (optinally) write cwd according to the tree it gets
 # workflow: tree -> index -> cwd
-# write tree to index
-# - open index and clear it
-# - we have function get_tree that return dict that looks like our index
-# - just update index according to the tree we have
-# - if update_cwd, write cwd from index
-def read_tree(oid: str, update_cwd: bool = False) -> None:
-    with data.get_index() as index:
-        index.clear()
-        index.update(get_tree(oid))
-        if update_cwd:
-            _index_write_cwd(index)
-
-
-# from index, write cwd
-# - empty cwd
-# - go through index items
-# - makedirs in each item (exist_ok=True)
-# - write the file
-def _index_write_cwd(index: Dict[str, str]) -> None:
-    _empty_current_dir()
-    for path, oid in index.items():
-        path = os.path.join(".", path) # not sure if the stored path is relative
-        dir_name = os.path.dirname(path)
+def read_tree(oid: str, update_cwd: bool = False, jobs: int = 1) -> None:
+    with data.get_index(write=True) as index:
+        _update_index(index, get_tree(oid), update_cwd, jobs)
+
+
+# make the index hold exactly the given tree
+# - paths not in tree are removed
+# - paths whose oid changed get a new entry (no stat data yet)
+# - paths that keep their oid keep their entry, stat data included
+# - if update_cwd, apply only what changed to cwd (with jobs threads)
+def _update_index(index: data.Index, tree: Tree, update_cwd: bool, jobs: int = 1) -> None:
+    old_tree = {path: entry.oid for path, entry in index.items()}
+    for path in old_tree.keys() - tree.keys():
+        del index[path]
+    for path, oid in tree.items():
+        if old_tree.get(path) != oid:
+            index[path] = data.IndexEntry(oid)
+
+    if update_cwd:
+        _index_write_cwd(index, old_tree, jobs)
+
+
+# from index, write cwd. we only touch the paths that differ between old_tree
+# (what the index had, so what cwd should have) and the index now: other
+# files, tracked or untracked, are left alone with their mtime.
+# for a big checkout (e.g. first one), files are written by a pool of jobs
+# threads, each one stream its blob out of the store into the file
+def _index_write_cwd(index: data.Index, old_tree: Tree, jobs: int = 1) -> None:
+    new_tree = {path: entry.oid for path, entry in index.items()}
+    changes = list(diff.iter_changed_files(new_tree, old_tree))
+
+    # delete first, a deleted file can be where a new directory goes
+    for path, change_type in changes:
+        if change_type == "deleted":
+            _remove_from_cwd(path)
+
+    paths = [path for path, change_type in changes if change_type != "deleted"]
+    # a partial clone gets the blobs it doesn't have in one round trip, not one per file
+    data.fetch_promised_objects(new_tree[path] for path in paths)
+    # make every directory before any write, so workers only create files
+    for dir_name in sorted({os.path.dirname(os.path.join(".", path)) for path in paths}):
         os.makedirs(dir_name, exist_ok=True)
 
-        content = data.get_object_content(oid, expected="blob")
-        with open(path, "wb") as file:
-            file.write(content)
+    def write_file(path: str) -> os.stat_result:
+        file_path = os.path.join(".", path) # not sure if the stored path is relative
+        with open(file_path, "wb") as file:
+            for chunk in data.iter_object_content(new_tree[path], expected="blob"):
+                file.write(chunk)
+        return os.stat(file_path)
 
+    with ThreadPoolExecutor(max_workers=_job_count(jobs)) as executor:
+        for path, stat in zip(paths, executor.map(write_file, paths)):
+            index[path] = data.index_entry(new_tree[path], stat)
 
-# like name said, empty the current dir (ignore .rgit)
-# we call it before doing read_tree.
-def _empty_current_dir():
-    for (root, dirnames, filenames) in os.walk(".", topdown=False):
-        for filename in filenames:
-            path = os.path.relpath(f"{root}/{filename}")
-            if is_ignored(path) or not os.path.isfile(path):
-                continue
-            os.remove(path)
 
-        for dirname in dirnames:
-            path = os.path.relpath(f"{root}/{dirname}")
-            if is_ignored(path):
-                continue
+# jobs <= 0 means one per cpu
+def _job_count(jobs: int) -> int:
+    if jobs <= 0:
+        return os.cpu_count() or 1
+    return jobs
+
+
+# remove the file, then its parent dirs as long as they are empty
+def _remove_from_cwd(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+    dir_name = os.path.dirname(path)
+    while dir_name:
+        try:
+            os.rmdir(dir_name)
+        except OSError:
+            # the dir still has untracked or ignored files, keep it
+            break
+        dir_name = os.path.dirname(dir_name)
 
-            try:
-                os.rmdir(path)
-            except (FileNotFoundError, OSError):
-                # some dir has ignored files, we can't delete the non-empty dir
-                # so we just pass
-                pass
 
 # get message, write tree then hash the commit object
 def commit(message: str) -> str:
@@ -177,16 +201,72 @@ def commit(message: str) -> str:
     commit_oid = data.hash_object(commit_content.encode(), type_="commit")
     # deref=True because we want to update the non-symbolic one, not shallow ref
     data.update_ref("HEAD", data.RefValue(symbolic=False, value=commit_oid), deref=True)
+    _update_commit_graph(commit_oid)
 
     return commit_oid
 
 
+# if we have a commit-graph, add the new commit to it. with any ancestor the
+# graph doesn't have yet too (e.g. the fetched branch we just merged)
+def _update_commit_graph(commit_oid: str) -> None:
+    if not graph.exists():
+        return
+    missing: graph.Commits = {}
+    stack = [commit_oid]
+    while stack:
+        oid = stack.pop()
+        if not oid or oid in missing or graph.contains(oid):
+            continue
+        commit = get_commit(oid)
+        assert commit is not None
+        missing[oid] = (commit.tree, _get_graph_parents(oid, commit))
+        stack.extend(missing[oid][1])
+    graph.append(missing)
+
+
+# write a commit-graph of every commit reachable from our refs, return the count
+def write_commit_graph() -> int:
+    tips = {ref_value.value for _, ref_value in data.iter_refs(deref=True)}
+    commits: graph.Commits = {}
+    stack = list(tips)
+    while stack:
+        oid = stack.pop()
+        if not oid or oid in commits:
+            continue
+        commit = get_commit(oid)
+        assert commit is not None
+        commits[oid] = (commit.tree, _get_graph_parents(oid, commit))
+        stack.extend(commits[oid][1])
+    return graph.write(commits)
+
+
+# the graph stores a shallow commit without parents, like get_parents return it.
+# we don't ask the graph itself here, it may be from before the cut points changed
+def _get_graph_parents(oid: str, commit: Commit) -> list[str]:
+    return [] if oid in data.get_shallow() else commit.parents
+
+
+# parents of a commit, from the commit-graph if it has the commit.
+# the cut points of a shallow repo have none, their parents aren't here
+def get_parents(oid: str) -> list[str]:
+    if oid in data.get_shallow():
+        return []
+    info = graph.lookup(oid)
+    if info is not None:
+        return info.parents
+    commit = get_commit(oid)
+    return commit.parents if commit else []
+
+
 # get the oid of the commit, parse the data then return
 # the Commit object (explicit fields, better than normal dict)
 def get_commit(oid: str) -> Commit | None:
     if not oid:
         return None
-    commit_content = data.get_object_content(oid, expected="commit")
+    return data.get_parsed_object(oid, "commit", _parse_commit)
+
+
+def _parse_commit(commit_content: bytes) -> Commit:
     tree, parents = "", []
 
     # iter takes a list and return iterator, an object you can call next() to
@@ -200,7 +280,8 @@ def get_commit(oid: str) -> Commit | None:
         if key == "tree":
             tree = value
         elif key == "parent":
-            parents.append(value)
+            if value: # a root commit written with an empty ref has "parent " line
+                parents.append(value)
         else:
             raise ValueError(f"unknown field {key}")
 
@@ -215,21 +296,22 @@ def _is_branch(name: str) -> bool:
 
 
 # find the commit oid, read tree from it and update head to the shallow ref (if exist)
-def checkout(commit: str) -> None:
+def checkout(commit: str, jobs: int = 1) -> None:
     symbolic = _is_branch(commit)
     if symbolic:
         commit = os.path.join("refs", "heads", commit) # update commit to real path
         ref_value = data.get_ref_value(commit, deref=True)
         assert ref_value is not None
         commit_oid = ref_value.value
-    else:
-        commit_oid = commit
+    else: # a tag, a full or short oid, ...: HEAD get detached at the oid
+        commit_oid = get_oid(commit)
+        commit = commit_oid
 
     commit_data = get_commit(commit_oid)
     if not commit_data:
         raise FileNotFoundError(f"commit {commit_oid} from input {commit} not found")
 
-    read_tree(commit_data.tree, update_cwd= True)
+    read_tree(commit_data.tree, update_cwd= True, jobs=jobs)
     # deref=False because we want HEAD to be able to be symbolic (point to a branch, not oid)
     data.update_ref("HEAD", data.RefValue(symbolic=symbolic, value=commit), deref=False)
 
@@ -260,8 +342,15 @@ def get_oid(name: str) -> str:
         return found_hash.value # sure that it is not symbolic
     elif _is_hash(name): #  this means the name is already oid
         return name
-    else:
-        raise ValueError(f"couldn't get oid from name {name}")
+
+    # maybe a short oid, it has to match exactly one object
+    matches = data.find_objects_by_prefix(name)
+    if len(matches) == 1:
+        return matches[0]
+    elif len(matches) > 1:
+        candidates = ", ".join(match[:12] for match in matches[:5])
+        raise ValueError(f"short oid {name} is ambiguous: {candidates}")
+    raise ValueError(f"couldn't get oid from name {name}")
 
 
 # Yield as many commit it can reach from commit oids
@@ -274,15 +363,13 @@ def iter_commits_and_parents(commit_oids: set[str]) -> Iterator[str]:
         visited.add(oid)
         yield oid
 
-        commit = get_commit(oid)
-        if not commit:
-            continue
-        elif commit.parents:
+        parents = get_parents(oid)
+        if parents:
             # we want to do DFS in each branch separately, so if we're at intersection
             # we will push first parent to the stack (append)
             # and other parents (branches) to the queue (extendleft)
-            oids_queue.append(commit.parents[0]) # extend takes a list btw
-            oids_queue.extendleft(commit.parents[1:])
+            oids_queue.append(parents[0]) # extend takes a list btw
+            oids_queue.extendleft(parents[1:])
 
 
 # create a branch file in refs/heads/ then write the oid to the branch
@@ -313,22 +400,41 @@ def reset(commit_oid: str, hard: bool) -> None:
 
     data.update_ref("HEAD", data.RefValue(symbolic=False, value=commit_oid), deref=True)
     if hard:
-        read_tree(commit.tree)
+        read_tree(commit.tree, update_cwd=True)
 
 
-# get a Tree for working directory
+# get a Tree for working directory, without the ignored files (see ignore.py).
+# a file whose stat data still match its index entry reuse the oid from index,
+# others are hashed (but not written to objects, they aren't staged)
 def get_working_tree(start_point: str = ".") -> Tree:
     working_tree = {}
-    for path, _, filenames in os.walk(start_point):
-        if is_ignored(path): continue
-        for filename in filenames:
-            file_path = os.path.join(path, filename)
-            with open(file_path, "rb") as file:
-                file_bytes = file.read()
-            target_path = os.path.relpath(file_path)
-            oid = data.hash_object(file_bytes, type_="blob")
+    with data.get_index() as index:
+        def add_file(target_path: str) -> None:
+            stat = os.stat(target_path)
+            entry = index.get(target_path)
+            if entry is not None and data.stat_matches(entry, stat):
+                working_tree[target_path] = entry.oid
+                return
+
+            with open(target_path, "rb") as file:
+                oid = data.hash_file(file, type_="blob", write=False)
+            # only the stat data was stale (e.g. touched), refresh it
+            if entry is not None and entry.oid == oid:
+                index[target_path] = data.index_entry(oid, stat)
             working_tree[target_path] = oid
 
+        for target_path in ignore.iter_files(start_point):
+            add_file(target_path)
+
+        # like git, ignore rules are for untracked files: a tracked file that
+        # match one (or is in an ignored dir) is still part of the tree
+        prefix = os.path.relpath(start_point)
+        for target_path in list(index):
+            if target_path in working_tree or not os.path.isfile(target_path):
+                continue
+            if prefix == "." or target_path.startswith(prefix + "/"):
+                add_file(target_path)
+
     return working_tree
 
 
@@ -341,8 +447,6 @@ def read_tree_merged(
     base_tree_oid: str,
     update_cwd: bool = False
 ) -> list[str]:
-    _empty_current_dir()
-
     head_tree = get_tree(head_tree_oid)
     other_tree = get_tree(other_tree_oid)
     base_tree = get_tree(base_tree_oid)
@@ -350,16 +454,16 @@ def read_tree_merged(
     # merged_tree is Tree, conflict_files is list[str]
     merged_tree, conflict_files = diff.merge_trees(head_tree, other_tree, base_tree)
     # update index first
-    with data.get_index() as index:
-        index.clear()
-        index.update(merged_tree)
-        if update_cwd:
-            _index_write_cwd(index)
+    with data.get_index(write=True) as index:
+        _update_index(index, merged_tree, update_cwd)
 
     return conflict_files
 
 
 def commit_to_tree_oid(commit_oid: str) -> str:
+    info = graph.lookup(commit_oid)
+    if info is not None:
+        return info.tree
     commit = get_commit(commit_oid)
     assert commit is not None
     return commit.tree
@@ -376,17 +480,19 @@ def _fast_forward(commit_oid: str) -> None:
 # receive any commit oid to merge into, then merge it into HEAD
 def merge(commit_oid: str) -> None:
     head_oid = get_oid("HEAD")
-    base_oid = get_merge_base(head_oid, commit_oid)
+    base_oids = get_merge_bases(head_oid, commit_oid)
 
-    if base_oid == head_oid:
+    if commit_oid in base_oids:
+        print(f"Already up to date with {commit_oid[:10]}")
+        return
+    if head_oid in base_oids:
         _fast_forward(commit_oid)
         print(f"Fast-forward to {commit_oid}")
         return
 
     head_tree_oid = commit_to_tree_oid(head_oid)
     other_tree_oid = commit_to_tree_oid(commit_oid)
-    base_tree_oid = commit_to_tree_oid(base_oid)
-
+    base_tree_oid = _merge_base_tree_oid(base_oids)
 
     conflict_files = read_tree_merged(
         head_tree_oid, other_tree_oid,
@@ -404,29 +510,163 @@ def merge(commit_oid: str) -> None:
 
 
 
-# get 2 commit oids and return the commit oid of nearest common ancestor
-# Note: I use BFS here because I think it's optimal.
+# when the branches have more than one best base (criss-cross merges), merge the
+# bases together first and use that as the base, like git's recursive strategy.
+# conflicts inside this virtual base just stay as markers in its content
+def _merge_base_tree_oid(base_oids: list[str]) -> str:
+    if not base_oids: # unrelated histories, the base is an empty tree
+        return ""
+    if len(base_oids) == 1:
+        return commit_to_tree_oid(base_oids[0])
+
+    merged_tree = get_tree(commit_to_tree_oid(base_oids[0]))
+    for other_oid in base_oids[1:]:
+        base_tree_oid = _merge_base_tree_oid(get_merge_bases(base_oids[0], other_oid))
+        merged_tree, _ = diff.merge_trees(
+            merged_tree, get_tree(commit_to_tree_oid(other_oid)), get_tree(base_tree_oid))
+    return _write_tree_from_paths(merged_tree)
+
+
+# generation of a commit: 1 for a root, otherwise 1 + max of its parents'.
+# read from the commit-graph when it's there, computed (and memoized in
+# generations) by walking the parents when it isn't
+def _get_generation(oid: str, generations: Dict[str, int]) -> int:
+    stack = [oid]
+    while stack:
+        current = stack[-1]
+        if current in generations:
+            stack.pop()
+            continue
+        generation = graph.get_generation(current)
+        if generation is not None:
+            generations[current] = generation
+            stack.pop()
+            continue
+        parents = get_parents(current)
+        pending = [parent for parent in parents if parent not in generations]
+        if pending:
+            stack.extend(pending)
+            continue
+        generations[current] = 1 + max((generations[parent] for parent in parents), default=0)
+        stack.pop()
+    return generations[oid]
+
+
+# above any generation the commit-graph can store (4 bytes)
+_UNKNOWN_GENERATION = 1 << 32
+
+
+# what the history walks below order by, highest first. the commit-graph
+# gives exact generations. a commit it doesn't have (there's no graph, or
+# the commit was made since) can't be an ancestor of one it has, so it goes
+# first. we don't walk to the root to compute it: that would make every walk
+# cost the whole history. the walks fix up a commit popped too early instead
+def _walk_generation(oid: str) -> int:
+    generation = graph.get_generation(oid)
+    return _UNKNOWN_GENERATION if generation is None else generation
+
+
+# paint flags for get_merge_bases
+_PARENT_A = 1
+_PARENT_B = 2
+_STALE = 4 # reachable from a base we already found, can't be a best base
+_RESULT = 8
+
+
+# return every best common ancestor of 2 commits (usually just one).
+# we walk both sides at once, highest generation first, painting each commit
+# with the side(s) it is reachable from. a commit painted by both sides is a
+# base, and everything below it is painted stale. with the commit-graph, a
+# commit is only popped after all its descendants in the walk, so no base we
+# return is an ancestor of another one. the walk stops when only stale commits
+# are left in the queue. without the graph it's a plain paint walk (commits
+# get painted again when a new side reaches them), and a base the stale paint
+# didn't get to in time is dropped at the end
+def get_merge_bases(oid_a: str, oid_b: str) -> list[str]:
+    if oid_a == oid_b:
+        return [oid_a]
+
+    flags = {oid_a: _PARENT_A, oid_b: _PARENT_B}
+    order = itertools.count() # same generation: first pushed, first popped
+    # (-generation, push order, oid, stale when pushed), heapq is a min heap
+    queue = [
+        (-_walk_generation(oid_a), next(order), oid_a, False),
+        (-_walk_generation(oid_b), next(order), oid_b, False),
+    ]
+    active = len(queue) # entries that weren't stale when pushed
+    exact = True # every generation we used came from the graph
+
+    bases = []
+    while active:
+        generation, _, oid, stale = heapq.heappop(queue)
+        exact = exact and generation != -_UNKNOWN_GENERATION
+        if not stale:
+            active -= 1
+        paint = flags[oid] & (_PARENT_A | _PARENT_B | _STALE)
+        if paint == _PARENT_A | _PARENT_B:
+            if not flags[oid] & _RESULT:
+                flags[oid] |= _RESULT
+                bases.append(oid)
+            paint |= _STALE
+
+        for parent in get_parents(oid):
+            if flags.get(parent, 0) & paint == paint:
+                continue
+            flags[parent] = flags.get(parent, 0) | paint
+            parent_stale = bool(paint & _STALE)
+            heapq.heappush(queue, (-_walk_generation(parent), next(order), parent, parent_stale))
+            if not parent_stale:
+                active += 1
+
+    # a base found before the stale paint reached it is not a best one
+    bases = [oid for oid in bases if not flags[oid] & _STALE]
+    if not exact and len(bases) > 1:
+        bases = _remove_redundant_bases(bases)
+    return bases
+
+
+# drop the bases that are an ancestor of another one. only needed when the
+# walk had no generations, and there are rarely more than 2 bases
+def _remove_redundant_bases(bases: list[str]) -> list[str]:
+    redundant: set[str] = set()
+    for oid in bases:
+        if oid in redundant: continue
+        others = set(bases) - {oid}
+        ancestors = iter_commits_and_parents(set(get_parents(oid)))
+        redundant.update(ancestor for ancestor in ancestors if ancestor in others)
+    return [oid for oid in bases if oid not in redundant]
+
+
+# get 2 commit oids and return the commit oid of a nearest common ancestor
 def get_merge_base(oid_a: str, oid_b: str) -> str:
-    visited: Dict[str, set[str]] = { "a": set(), "b": set() }
-    queue = deque([(oid_a, "a"), (oid_b, "b")])
-    while queue:
-        oid, branch = queue.popleft()
-        other_branch = "a" if branch == "b" else "a"
-        if oid in visited[other_branch]:
-            return oid
-
-        commit = get_commit(oid)
-        if commit is None: continue
-        for parent in commit.parents:
-            queue.append((parent, branch))
-        visited[branch].add(oid)
-    raise ValueError(f"couldn't find ancestor for {oid_a[:10]} {oid_b[:10]}")
+    bases = get_merge_bases(oid_a, oid_b)
+    if not bases:
+        raise ValueError(f"couldn't find ancestor for {oid_a[:10]} {oid_b[:10]}")
+    return bases[0]
 
 
 # receive list of commits and yield all objects it found when traverse
 # these commits. note that we don't visit remote repo in this function
-# but will yield the oid we foudn to the caller to let it fetch if missing
-def iter_objects_in_commits(commit_oids: set[str]) -> Iterator[str]:
+# but will yield the oid we foudn to the caller to let it fetch if missing.
+# with exclude (commits the other side already has), we stop at them and
+# skip every tree/blob they have, so we only yield what is new.
+# when a pack has reachability bitmaps we answer from them instead.
+# with depth, we only go depth commits down from commit_oids (fetch --depth),
+# with blobs=False we skip every blob (fetch --filter=blob:none)
+def iter_objects_in_commits(
+    commit_oids: set[str],
+    exclude: Iterable[str] = (),
+    use_bitmaps: bool = True,
+    depth: int | None = None,
+    blobs: bool = True
+) -> Iterator[str]:
+    have_oids = {oid for oid in exclude if oid}
+    # a bitmap doesn't know the object types
+    bitmaps = bitmap.find() if use_bitmaps and depth is None and blobs else None
+    if bitmaps is not None:
+        yield from _iter_objects_with_bitmaps(bitmaps, commit_oids, have_oids)
+        return
+
     visited = set() # every tree/blob we visit
     # for get all objects from tree
     def iter_objects_in_tree(tree_oid: str) -> Iterator[str]:
@@ -437,23 +677,308 @@ def iter_objects_in_commits(commit_oids: set[str]) -> Iterator[str]:
             if oid in visited: continue
             if type_ == "tree":
                 yield from iter_objects_in_tree(oid)
-            else:
+            elif blobs:
                 visited.add(oid)
                 yield oid
 
-    # iterate every commit we can touch (function guarantee no duplicate)
-    for commit_oid in iter_commits_and_parents(commit_oids):
+    if depth is not None:
+        # we walk through the commits the other side has, it may have less
+        # history below them than we send now (a deeper fetch)
+        shallow_commits, _ = get_shallow_commits(commit_oids, depth)
+        new_commits: Iterable[str] = [oid for oid in shallow_commits if oid not in have_oids]
+        for have_oid in have_oids:
+            for _ in iter_objects_in_tree(commit_to_tree_oid(have_oid)): pass
+    elif not have_oids:
+        # iterate every commit we can touch (function guarantee no duplicate)
+        new_commits = iter_commits_and_parents(commit_oids)
+    else:
+        new_commits, edges = _get_new_commits(commit_oids, have_oids)
+        # the other side has every object in the trees we stop at
+        for edge_oid in edges:
+            for _ in iter_objects_in_tree(commit_to_tree_oid(edge_oid)): pass
+
+    for commit_oid in new_commits:
         yield commit_oid # let caller have a chance to fetch
-        commit = get_commit(commit_oid)
-        assert commit
-        if commit.tree in visited: continue
-        yield from iter_objects_in_tree(commit.tree)
+        tree_oid = commit_to_tree_oid(commit_oid)
+        if tree_oid in visited: continue
+        yield from iter_objects_in_tree(tree_oid)
+
+
+# objects reachable from commit_oids but not from exclude, as bitmap(want) & ~bitmap(have).
+# objects outside the bitmapped pack (e.g. commits made since) are listed separately
+def _iter_objects_with_bitmaps(bitmaps: bitmap.Bitmaps, commit_oids: set[str], exclude: set[str]) -> Iterator[str]:
+    want_bits, want_extra = _get_reachable_bits(bitmaps, commit_oids, {})
+    have_bits, have_extra = _get_reachable_bits(bitmaps, exclude, {})
+    yield from sorted(want_extra - have_extra)
+    for position in bitmap.iter_positions(want_bits & ~have_bits):
+        yield pack.oid_at(bitmaps.pack, position)
+
+
+# return (bitset over the pack, oids not in the pack) of everything reachable
+# from commit_oids. we walk commits and trees like iter_objects_in_commits, but
+# a commit that already has a bitmap (stored, or in known) is just OR-ed in
+def _get_reachable_bits(
+    bitmaps: bitmap.Bitmaps,
+    commit_oids: Iterable[str],
+    known: Dict[str, int]
+) -> Tuple[int, set[str]]:
+    object_pack = bitmaps.pack
+    seen = bytearray((object_pack.count + 7) // 8) # mutable while we walk
+    extra: set[str] = set()
+
+    def is_marked(oid: str) -> bool:
+        position = pack.find_position(object_pack, oid)
+        if position < 0:
+            return oid in extra
+        return bool(seen[position >> 3] & (1 << (position & 7)))
+
+    # return False if it was already marked
+    def mark(oid: str) -> bool:
+        position = pack.find_position(object_pack, oid)
+        if position < 0:
+            if oid in extra: return False
+            extra.add(oid)
+            return True
+        if seen[position >> 3] & (1 << (position & 7)): return False
+        seen[position >> 3] |= 1 << (position & 7)
+        return True
+
+    def mark_tree(tree_oid: str) -> None:
+        if not mark(tree_oid): return # already marked with everything inside
+        for type_, oid, _ in _iter_tree_entries(tree_oid):
+            if type_ == "tree":
+                mark_tree(oid)
+            else:
+                mark(oid)
+
+    stack = [oid for oid in commit_oids if oid]
+    while stack:
+        oid = stack.pop()
+        if is_marked(oid): continue
+        stored = known[oid] if oid in known else bitmap.get(bitmaps, oid)
+        if stored is not None:
+            seen[:] = (int.from_bytes(seen, "little") | stored).to_bytes(len(seen), "little")
+            continue
+        mark(oid)
+        mark_tree(commit_to_tree_oid(oid))
+        stack.extend(get_parents(oid))
+    return (int.from_bytes(seen, "little"), extra)
+
+
+# a commit every this many generations get a bitmap (all ref tips get one too),
+# so a walk never goes far before it can OR a bitmap in
+BITMAP_COMMIT_INTERVAL = 100
+
+
+# write reachability bitmaps for a pack that holds everything (right after
+# repack --all), return how many commits got one
+def write_bitmaps(pack_name: str) -> int:
+    object_pack = next(object_pack for object_pack in data.get_packs() if object_pack.name == pack_name)
+    tips = {ref_value.value for _, ref_value in data.iter_refs(deref=True)
+        if ref_value.value and data.object_exists(ref_value.value)}
+
+    generations: Dict[str, int] = {}
+    commits = sorted(iter_commits_and_parents(tips), key=lambda oid: (_get_generation(oid, generations), oid))
+    selected = [oid for i, oid in enumerate(commits) if oid in tips or i % BITMAP_COMMIT_INTERVAL == 0]
+
+    # parents first, so each walk can stop at the bitmaps we just made
+    empty = bitmap.Bitmaps(pack=object_pack, entries={}, data=b"")
+    known: Dict[str, int] = {}
+    for oid in selected:
+        bits, extra = _get_reachable_bits(empty, {oid}, known)
+        if not extra: # it reaches something outside the pack, can't have a bitmap
+            known[oid] = bits
+    bitmap.write(object_pack, known)
+    return len(known)
+
+
+# unreachable objects younger than this are never pruned: a command running
+# right now may have written them and not updated a ref yet
+GC_EXPIRE_SECONDS = 14 * 24 * 3600
+GcResult = namedtuple("GcResult", ["pack", "packed", "pruned", "freed"])
+
+
+# every object reachable from a ref (HEAD, MERGE_HEAD, branches, tags, remote
+# branches) or from the index. blobs a partial clone doesn't have are in it too.
+# prune and gc delete everything else, so we walk the commits and trees
+# ourselves: a bitmap that's wrong would turn straight into lost objects
+def get_reachable_objects() -> set[str]:
+    tips = {ref_value.value for _, ref_value in data.iter_refs(deref=True) if ref_value.value}
+    reachable = set(iter_objects_in_commits(tips, use_bitmaps=False))
+    with data.get_index() as index:
+        reachable.update(entry.oid for entry in index.values())
+    return reachable
 
 
+# a path for each tree and blob reachable from the refs (the first one we
+# meet), repack sorts by it to find deltas between versions of a file
+def get_object_paths() -> Dict[str, str]:
+    paths: Dict[str, str] = {}
+
+    def visit_tree(tree_oid: str, tree_path: str) -> None:
+        paths[tree_oid] = tree_path
+        for type_, oid, name in _iter_tree_entries(tree_oid):
+            if oid in paths: continue
+            if type_ == "tree":
+                visit_tree(oid, os.path.join(tree_path, name))
+            else:
+                paths[oid] = os.path.join(tree_path, name)
+
+    tips = {ref_value.value for _, ref_value in data.iter_refs(deref=True) if ref_value.value}
+    for commit_oid in iter_commits_and_parents(tips):
+        tree_oid = commit_to_tree_oid(commit_oid)
+        if tree_oid not in paths:
+            visit_tree(tree_oid, "")
+    return paths
+
+
+# delete the unreachable loose objects older than expire_seconds,
+# return (objects deleted, bytes freed)
+def prune(expire_seconds: int = GC_EXPIRE_SECONDS) -> Tuple[int, int]:
+    return data.prune_loose_objects(get_reachable_objects(), time.time() - expire_seconds)
+
+
+# repack every reachable object into one pack (with bitmaps if we had them),
+# then prune. unreachable packed objects go loose first, so they get the grace
+# period too
+# freed is the bytes of the loose objects and old packs deleted, like prune's
+# (the new pack, bitmaps and commit-graph aren't taken off)
+def gc(expire_seconds: int = GC_EXPIRE_SECONDS) -> GcResult:
+    had_bitmaps = bitmap.find() is not None
+    reachable = get_reachable_objects()
+    packed = data.repack(all_objects=True, keep=reachable, paths=get_object_paths())
+    if packed is not None and had_bitmaps:
+        write_bitmaps(packed[0])
+    data.shard_legacy_objects() # what an old rgit left flat and we didn't pack
+    pruned, pruned_bytes = data.prune_loose_objects(reachable, time.time() - expire_seconds)
+    name, count, repacked_bytes = packed if packed is not None else ("", 0, 0)
+    return GcResult(pack=name, packed=count, pruned=pruned, freed=repacked_bytes + pruned_bytes)
+
+
+# return the commits reachable from commit_oids but not from exclude, and the
+# edges: excluded commits that are parents of those. we walk the highest
+# generation first, so with the commit-graph, by the time we pop a commit every
+# descendant of it in the walk is done, and we know if exclude can reach it.
+# without it (see _walk_generation) a commit can be popped as new and reached
+# from exclude later: then it's taken back and walked again as excluded.
+# the walk stops when only excluded commits are left, so it costs the new
+# commits, not all history. without the graph a commit exclude reach through
+# a path we didn't walk yet may still be in the result, the other side just
+# gets objects it already has
+def _get_new_commits(commit_oids: set[str], exclude: set[str]) -> Tuple[list[str], set[str]]:
+    excluded: Dict[str, bool] = {} # every commit we queued -> is it reachable from exclude
+    order = itertools.count() # same generation: first pushed, first popped
+    queue: list[Tuple[int, int, str]] = []
+    wanted = 0 # queued commits that aren't excluded (yet)
+    new_commits: Dict[str, None] = {} # popped as new, in order
+
+    def enqueue(oid: str, is_excluded: bool) -> None:
+        nonlocal wanted
+        if oid in excluded:
+            if is_excluded and not excluded[oid]:
+                excluded[oid] = True
+                if oid in new_commits: # popped too early, its parents are excluded too
+                    del new_commits[oid]
+                    heapq.heappush(queue, (-_walk_generation(oid), next(order), oid))
+                else:
+                    wanted -= 1
+            return
+        excluded[oid] = is_excluded
+        heapq.heappush(queue, (-_walk_generation(oid), next(order), oid))
+        if not is_excluded:
+            wanted += 1
+
+    for oid in exclude:
+        enqueue(oid, True)
+    for oid in commit_oids:
+        if oid: enqueue(oid, False)
+
+    while wanted:
+        _, _, oid = heapq.heappop(queue)
+        is_excluded = excluded[oid]
+        if not is_excluded:
+            wanted -= 1
+            new_commits[oid] = None
+        for parent in get_parents(oid):
+            enqueue(parent, is_excluded)
+
+    edges = {parent for oid in new_commits for parent in get_parents(oid) if excluded.get(parent)}
+    return (list(new_commits), edges)
+
+
+# return the commits at most depth commits down from commit_oids (a tip is at
+# depth 1), and the cut points among them: the ones we stop at while they still
+# have parents, and the cut points we already have if we are shallow ourselves
+def get_shallow_commits(commit_oids: Iterable[str], depth: int) -> Tuple[list[str], set[str]]:
+    assert depth > 0, "depth must be at least 1"
+    depths = {oid: 1 for oid in commit_oids if oid}
+    queue = deque(depths)
+    shallow = data.get_shallow()
+    commits, cut = [], set()
+    while queue: # breadth first, so each commit gets its shortest depth
+        oid = queue.popleft()
+        commits.append(oid)
+        parents = get_parents(oid)
+        if oid in shallow or (parents and depths[oid] == depth):
+            cut.add(oid)
+            continue
+        for parent in parents:
+            if parent not in depths:
+                depths[parent] = depths[oid] + 1
+                queue.append(parent)
+    return (commits, cut)
+
+
+# the cut points that go with a fetch of commit_oids that sends objects
+def get_shallow_cut(commit_oids: Iterable[str], objects: Iterable[str], depth: int | None) -> set[str]:
+    if depth is not None:
+        return get_shallow_commits(commit_oids, depth)[1]
+    # a complete fetch from a shallow repo is only as deep as that repo
+    shallow = data.get_shallow()
+    return {oid for oid in objects if oid in shallow}
+
+
+# after a fetch: add the cut points it sent, and drop the ones we have every
+# parent of now (a deeper fetch). generations and reachability bitmaps depend
+# on the cut points, so when they change a commit-graph is written again and
+# the bitmaps are deleted (they can only be rebuilt after a repack -a)
+def update_shallow(cut: Iterable[str]) -> None:
+    old_shallow = data.get_shallow()
+    shallow = set()
+    for oid in old_shallow | set(cut):
+        commit = get_commit(oid)
+        assert commit is not None
+        if not all(data.object_exists(parent) for parent in commit.parents):
+            shallow.add(oid)
+    if shallow == old_shallow:
+        return
+    data.write_shallow(shallow)
+    if graph.exists():
+        write_commit_graph()
+    for object_pack in data.get_packs():
+        bitmap.delete(object_pack)
+
+
+# with generation numbers we never walk below old_oid's generation:
+# a commit with generation <= old's (and isn't old) can't have old as ancestor
 def is_ancestor(old_oid: str, new_oid: str) -> bool:
-    for oid in iter_commits_and_parents({new_oid}):
+    old_generation = graph.get_generation(old_oid)
+    if old_generation is None: # not in the graph, we have to walk everything
+        return any(oid == old_oid for oid in iter_commits_and_parents({new_oid}))
+
+    visited = set()
+    stack = [new_oid]
+    while stack:
+        oid = stack.pop()
         if oid == old_oid:
             return True
+        if not oid or oid in visited:
+            continue
+        visited.add(oid)
+        generation = graph.get_generation(oid)
+        if generation is not None and generation <= old_generation:
+            continue
+        stack.extend(get_parents(oid))
     return False
 
 
@@ -461,38 +986,41 @@ def is_ancestor(old_oid: str, new_oid: str) -> bool:
 
 # receive a path to file, write the file into object
 # then write index: path -> oid
-def add(paths: list[str]) -> None:
-    def add_file(file_path: str) -> None:
+# with jobs > 1, files are read, hashed, compressed and written by a thread pool
+# (hashlib and zlib release the GIL on big chunks). each worker stream its file
+# in chunks, so memory stay around jobs * CHUNK_SIZE whatever the file sizes.
+# results come back in input order, so the index is the same as with jobs = 1
+def add(paths: list[str], jobs: int = 1) -> None:
+    def hash_file(file_path: str) -> data.IndexEntry:
         with open(file_path, "rb") as file:
-            content = file.read()
-
-        oid = data.hash_object(content, type_="blob")
-        index[file_path] = oid
-
-    def add_dir(dir_path: str) -> None:
-        for root, _, file_names in os.walk(dir_path):
-            for file_name in file_names:
-                file_path = os.path.relpath(os.path.join(root, file_name))
-                if is_ignored(file_path): continue
-                add_file(file_path)
+            # stat before reading, if the file change while we read it, the
+            # next status will see the new mtime and hash it again
+            stat = os.fstat(file.fileno())
+            oid = data.hash_file(file, type_="blob")
+        return data.index_entry(oid, stat)
+
+    file_paths = []
+    for path in paths:
+        if not os.path.exists(path):
+            print(f"path {path} does not exist")
+            continue
 
-    with data.get_index() as index:
-        for path in paths:
-            if not os.path.exists(path):
-                print(f"path {path} does not exist")
-                continue
+        if os.path.isfile(path):
+            file_paths.append(path)
+        elif os.path.isdir(path):
+            file_paths.extend(ignore.iter_files(path)) # ignored files only get in by name
+        else:
+            print(f"{path} is neither file nor directory")
 
-            if os.path.isfile(path):
-                add_file(path)
-            elif os.path.isdir(path):
-                add_dir(path)
-            else:
-                print(f"{path} is neither file nor directory")
+    with data.get_index(write=True) as index, ThreadPoolExecutor(max_workers=_job_count(jobs)) as executor:
+        entries = executor.map(hash_file, file_paths)
+        for file_path, entry in zip(file_paths, entries):
+            index[file_path] = entry
 
 
-def get_index_tree() -> Dict[str, str]:
+def get_index_tree() -> Tree:
     with data.get_index() as index:
-        return index
+        return {path: entry.oid for path, entry in index.items()}
 
 
 # just get commit -> read tree = update index + apply to cwd -> commit
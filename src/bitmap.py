@@ -0,0 +1,141 @@
+# bitmap module keep reachability bitmaps next to a pack: for some commits, the
+# set of every object reachable from it, as a bitset over the pack's object
+# order (bit i = the i-th oid of the .idx). "objects in A not in B" is then
+# just bitmap(A) & ~bitmap(B) instead of parsing all their trees.
+#
+# a commit only get a bitmap if everything it reaches is in the pack, so the
+# bitmaps are written right after everything was repacked into one pack.
+# what a commit reaches also depend on where a shallow repo's history stop,
+# so a bitmap written with other shallow cut points is ignored.
+#
+# .bitmap layout (pack-<sha>.bitmap, next to pack-<sha>.pack):
+#   header: b"RBMP" | version (4) | pack object count (4) | bitmap count (4)
+#   pack checksum: 20 bytes, the sha1 in the pack name (to pair them up)
+#   shallow checksum: 20 bytes, sha1 of the shallow cut points when written
+#   entries: commit oid (20) | length (4) | zlib(bitset as little-endian bytes)
+#   trailer: sha1 of everything above
+import os
+import zlib
+import struct
+import hashlib
+from collections import namedtuple
+from typing import Dict, Iterator, Tuple
+from src import data, pack
+
+MAGIC = b"RBMP"
+VERSION = 2
+OID_SIZE = 20
+
+_HEADER = struct.Struct(">4sIII")
+_ENTRY_HEADER = struct.Struct(">20sI")
+_DATA_START = _HEADER.size + 2 * OID_SIZE
+
+# bitmaps of one pack, entries: commit oid -> (offset, length) of its bitset
+Bitmaps = namedtuple("Bitmaps", ["pack", "entries", "data"])
+
+# bitmaps we already read: (RGIT_DIR, pack name, shallow checksum) -> bitmaps
+# (None if there is no file, or it can't be used)
+_loaded_bitmaps: Dict[Tuple[str, str, bytes], Bitmaps | None] = {}
+
+
+def _bitmap_path(object_pack: pack.Pack) -> str:
+    return os.path.join(data.RGIT_DIR, "objects", "pack", f"{object_pack.name}.bitmap")
+
+
+# the shallow cut points the bitmaps are good for
+def _shallow_checksum() -> bytes:
+    return hashlib.sha1("".join(f"{oid}\n" for oid in sorted(data.get_shallow())).encode()).digest()
+
+
+def load(object_pack: pack.Pack) -> Bitmaps | None:
+    shallow_checksum = _shallow_checksum()
+    key = (data.RGIT_DIR, object_pack.name, shallow_checksum)
+    if key in _loaded_bitmaps:
+        return _loaded_bitmaps[key]
+
+    bitmaps = None
+    if os.path.isfile(_bitmap_path(object_pack)):
+        with open(_bitmap_path(object_pack), "rb") as bitmap_file:
+            content = bitmap_file.read()
+        magic, version, object_count, count = _HEADER.unpack_from(content, 0)
+        assert magic == MAGIC, f"bad bitmap for {object_pack.name}"
+        pack_checksum = content[_HEADER.size:_HEADER.size + OID_SIZE].hex()
+        # bit positions only mean something for the pack they were written for,
+        # and what they reach for the history we had then (an older version
+        # didn't record it, so we can't trust it either)
+        if version == VERSION and object_count == object_pack.count \
+                and object_pack.name == f"pack-{pack_checksum}" \
+                and content[_HEADER.size + OID_SIZE:_DATA_START] == shallow_checksum:
+            entries = {}
+            offset = _DATA_START
+            for _ in range(count):
+                oid, length = _ENTRY_HEADER.unpack_from(content, offset)
+                offset += _ENTRY_HEADER.size
+                entries[oid.hex()] = (offset, length)
+                offset += length
+            bitmaps = Bitmaps(pack=object_pack, entries=entries, data=content)
+    _loaded_bitmaps[key] = bitmaps
+    return bitmaps
+
+
+# the first pack that has bitmaps, None if there isn't one
+def find() -> Bitmaps | None:
+    for object_pack in data.get_packs():
+        bitmaps = load(object_pack)
+        if bitmaps is not None:
+            return bitmaps
+    return None
+
+
+# objects reachable from commit oid as an int bitset, None if it has no bitmap
+def get(bitmaps: Bitmaps, oid: str) -> int | None:
+    entry = bitmaps.entries.get(oid)
+    if entry is None:
+        return None
+    offset, length = entry
+    return int.from_bytes(zlib.decompress(bitmaps.data[offset:offset + length]), "little")
+
+
+# position of every set bit, lowest first
+def iter_positions(bits: int) -> Iterator[int]:
+    raw = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+    for byte_index, byte in enumerate(raw):
+        if not byte: continue
+        for bit in range(8):
+            if byte >> bit & 1:
+                yield byte_index * 8 + bit
+
+
+# write the bitmaps of a pack (commit oid -> bitset), replacing the old file
+def write(object_pack: pack.Pack, bitmaps: Dict[str, int]) -> None:
+    byte_count = (object_pack.count + 7) // 8
+    entries = []
+    for oid in sorted(bitmaps):
+        compressed = zlib.compress(bitmaps[oid].to_bytes(byte_count, "little"))
+        entries.append(_ENTRY_HEADER.pack(bytes.fromhex(oid), len(compressed)) + compressed)
+
+    content = b"".join([
+        _HEADER.pack(MAGIC, VERSION, object_pack.count, len(entries)),
+        bytes.fromhex(object_pack.name.removeprefix("pack-")),
+        _shallow_checksum(),
+        *entries,
+    ])
+    path = _bitmap_path(object_pack)
+    with open(path + ".tmp", "wb") as bitmap_file:
+        bitmap_file.write(content + hashlib.sha1(content).digest())
+    data.move_into_place(path + ".tmp", path)
+    _forget(object_pack)
+
+
+# delete the bitmaps of a pack, e.g. when what they reach changed
+def delete(object_pack: pack.Pack) -> None:
+    try:
+        os.remove(_bitmap_path(object_pack))
+    except FileNotFoundError:
+        pass
+    _forget(object_pack)
+
+
+def _forget(object_pack: pack.Pack) -> None:
+    for key in [key for key in _loaded_bitmaps if key[:2] == (data.RGIT_DIR, object_pack.name)]:
+        del _loaded_bitmaps[key]
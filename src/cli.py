@@ -6,16 +6,31 @@ import textwrap # lib for wrapping multi-line string
 import subprocess # lib for openning other processes
 from collections import defaultdict
 from typing import Dict
-from src import data, base, diff, remote # if I want to import local lib, I have specify where it is
+from src import data, base, diff, remote, protocol, daemon # if I want to import local lib, I have specify where it is
 
 def main():
     with data.switch_rgit_dir("."):
         args = parse_args()
         args.func(args)
+    # RGIT_CACHE_STATS=1 rgit log: see how much the parsed-object cache helped
+    if os.environ.get("RGIT_CACHE_STATS"):
+        cache = data.parsed_objects
+        print(f"parsed-object cache: {cache.hits} hits, {cache.misses} misses, "
+            f"{cache.size} bytes", file=sys.stderr)
+
+
+# argparse hide a ValueError message behind "invalid value", but we want
+# users to see why (e.g. an ambiguous short oid)
+def _oid_type(name: str) -> str:
+    try:
+        return base.get_oid(name)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+
 
 def parse_args():
     parser = argparse.ArgumentParser() # parser object
-    oid = base.get_oid # a caster function they count as a type
+    oid = _oid_type # a caster function they count as a type
 
     # We will add sub-parser for handling sub-command
     commands = parser.add_subparsers(dest="command")
@@ -42,6 +57,10 @@ def parse_args():
 
     read_tree_parser = commands.add_parser("read-tree")
     read_tree_parser.add_argument("oid", type=oid)
+    # also update the working directory
+    read_tree_parser.add_argument("--update", "-u", action="store_true")
+    # number of files written at the same time, 0 means one per cpu
+    read_tree_parser.add_argument("--jobs", "-j", type=int, default=1)
     read_tree_parser.set_defaults(func=read_tree)
 
     commit_parser = commands.add_parser("commit")
@@ -55,6 +74,7 @@ def parse_args():
 
     checkout_parser = commands.add_parser("checkout")
     checkout_parser.add_argument("commit")
+    checkout_parser.add_argument("--jobs", "-j", type=int, default=1)
     checkout_parser.set_defaults(func=checkout)
 
     tag_parser = commands.add_parser("tag")
@@ -81,11 +101,14 @@ def parse_args():
 
     show_parser = commands.add_parser("show")
     show_parser.add_argument("commit", default="@", nargs="?", type=oid)
+    # use /usr/bin/diff instead of our own diff engine
+    show_parser.add_argument("--external-diff", action="store_true")
     show_parser.set_defaults(func=show)
 
     diff_parser = commands.add_parser("diff")
     diff_parser.add_argument("--cached", action="store_true")
     diff_parser.add_argument("commit", nargs="?", type=oid)
+    diff_parser.add_argument("--external-diff", action="store_true")
     diff_parser.set_defaults(func=show_diff)
 
     merge_parser = commands.add_parser("merge")
@@ -95,10 +118,15 @@ def parse_args():
     merge_base_parser = commands.add_parser("merge-base")
     merge_base_parser.add_argument("commit_oid_a", type=oid)
     merge_base_parser.add_argument("commit_oid_b", type=oid)
+    merge_base_parser.add_argument("--all", action="store_true")
     merge_base_parser.set_defaults(func=merge_base)
 
     fetch_parser = commands.add_parser("fetch")
     fetch_parser.add_argument("path")
+    # only the last N commits of each branch (shallow)
+    fetch_parser.add_argument("--depth", type=int)
+    # blob:none = commits and trees only, blobs are fetched when needed
+    fetch_parser.add_argument("--filter", dest="filter_spec", choices=remote.FILTER_SPECS)
     fetch_parser.set_defaults(func=fetch)
 
     push_parser = commands.add_parser("push")
@@ -106,15 +134,44 @@ def parse_args():
     push_parser.add_argument("branch")
     push_parser.set_defaults(func=push)
 
+    daemon_parser = commands.add_parser("daemon")
+    daemon_parser.add_argument("base_path", nargs="?", default=".")
+    daemon_parser.add_argument("--host", default="127.0.0.1")
+    daemon_parser.add_argument("--port", type=int, default=protocol.DEFAULT_PORT)
+    daemon_parser.set_defaults(func=run_daemon)
+
     add_parser = commands.add_parser("add")
     # takes >= 1 argument, wrap into list
     add_parser.add_argument("paths", nargs="+")
+    # number of files hashed at the same time, 0 means one per cpu
+    add_parser.add_argument("--jobs", "-j", type=int, default=1)
     add_parser.set_defaults(func=add)
 
     revert_parser = commands.add_parser("revert")
     revert_parser.add_argument("commit", type=oid)
     revert_parser.set_defaults(func=revert)
 
+    repack_parser = commands.add_parser("repack")
+    repack_parser.add_argument("--all", "-a", action="store_true")
+    repack_parser.add_argument("--write-bitmap", "-b", action="store_true")
+    repack_parser.set_defaults(func=repack)
+
+    gc_parser = commands.add_parser("gc")
+    # unreachable objects younger than this many seconds are kept, 0 = prune them all
+    gc_parser.add_argument("--expire", type=int, default=base.GC_EXPIRE_SECONDS)
+    gc_parser.set_defaults(func=gc)
+
+    prune_parser = commands.add_parser("prune")
+    prune_parser.add_argument("--expire", type=int, default=base.GC_EXPIRE_SECONDS)
+    prune_parser.set_defaults(func=prune)
+
+    pack_refs_parser = commands.add_parser("pack-refs")
+    pack_refs_parser.set_defaults(func=pack_refs)
+
+    commit_graph_parser = commands.add_parser("commit-graph")
+    commit_graph_parser.add_argument("action", choices=["write"])
+    commit_graph_parser.set_defaults(func=commit_graph)
+
     return parser.parse_args()
 
 
@@ -130,9 +187,7 @@ def clear(args):
 
 def hash_object(args):
     with open(args.file_path, "rb") as file:
-        file_content = file.read()
-
-    oid = data.hash_object(file_content)
+        oid = data.hash_file(file)
     print(f"hash object {args.file_path} -> {oid}")
 
 
@@ -154,11 +209,12 @@ def write_tree(args):
 
 
 def read_tree(args):
-    base.read_tree(args.oid)
+    base.read_tree(args.oid, update_cwd=args.update, jobs=args.jobs)
 
 
 def commit(args):
-    version_oid = base.commit(args.message)
+    with data.batch_fsync():
+        version_oid = base.commit(args.message)
     print(f"commit {version_oid}")
 
 
@@ -184,7 +240,7 @@ def log(args):
 
 
 def checkout(args):
-    base.checkout(args.commit)
+    base.checkout(args.commit, jobs=args.jobs)
     print(f"checkout {args.commit}, now HEAD is {args.commit}")
 
 
@@ -259,12 +315,13 @@ def status(args):
     latest_commit = base.get_commit(latest_commit_oid)
     assert latest_commit is not None
 
+    # HEAD vs index hash the index's directories in memory (nothing is
+    # written), so the ones that match HEAD's subtrees are skipped
     index_tree = base.get_index_tree()
-    head_tree = base.get_tree(latest_commit.tree)
     working_tree = base.get_working_tree()
 
     print("\nChanges to be commited:")
-    for (path, change_type) in diff.iter_changed_files(index_tree, head_tree):
+    for (path, change_type) in diff.iter_changed_files(index_tree, latest_commit.tree):
         print(f"    {change_type}: {path}")
 
     print("\nChanged not staged for commit:")
@@ -287,12 +344,9 @@ def show(args):
         parent_tree_oid = base.get_commit(parent).tree
         current_tree_oid = commit.tree
 
-        parent_tree = base.get_tree(parent_tree_oid)
-        current_tree = base.get_tree(current_tree_oid)
-        diff_msg = diff.diff_trees(current_tree, parent_tree)
-
-        sys.stdout.buffer.flush()
-        sys.stdout.buffer.write(diff_msg)
+        sys.stdout.flush()
+        for chunk in diff.diff_trees(current_tree_oid, parent_tree_oid, external=args.external_diff):
+            sys.stdout.buffer.write(chunk)
 
 
 # if --cached: we diff index with HEAD or provided commit
@@ -303,25 +357,27 @@ def show_diff(args):
         assert target_commit is not None
         return target_commit.tree
 
-    if args.cached:
-        index_tree_oid = base.write_tree()
-        main_tree = base.get_tree(index_tree_oid)
+    main_tree: base.Tree | str
+    target_tree: base.Tree | str
+    if args.cached: # both sides are tree objects, compare them by oid
+        main_tree = base.write_tree()
         if not args.commit:
             target_oid = base.get_oid("HEAD")
         else: target_oid = args.commit
-        target_tree_oid = commit_to_tree_oid(target_oid)
+        target_tree = commit_to_tree_oid(target_oid)
     else:
         main_tree = base.get_working_tree()
         if not args.commit:
-            target_tree_oid = base.write_tree()
+            target_tree = base.get_index_tree()
         else:
-            target_tree_oid = commit_to_tree_oid(args.commit)
-
-    target_tree = base.get_tree(target_tree_oid)
+            target_tree = base.get_tree(commit_to_tree_oid(args.commit))
 
-    diff_msg = diff.diff_trees(main_tree, target_tree)
-    sys.stdout.buffer.flush()
-    sys.stdout.buffer.write(diff_msg)
+    sys.stdout.flush()
+    for chunk in diff.diff_trees(
+        main_tree, target_tree,
+        to_worktree=not args.cached, external=args.external_diff
+    ):
+        sys.stdout.buffer.write(chunk)
 
 
 def merge(args):
@@ -330,14 +386,19 @@ def merge(args):
 
 
 def merge_base(args):
-    base_oid = base.get_merge_base(args.commit_oid_a, args.commit_oid_b)
-    print(f"the base is commit {base_oid[:10]}")
+    base_oids = base.get_merge_bases(args.commit_oid_a, args.commit_oid_b)
+    if not base_oids:
+        print("no common ancestor")
+        return
+    for base_oid in base_oids if args.all else base_oids[:1]:
+        print(f"the base is commit {base_oid[:10]}")
 
 
 def fetch(args):
     path = args.path
-    assert os.path.exists(path)
-    remote.fetch(path)
+    assert protocol.is_url(path) or os.path.exists(path)
+    with data.batch_fsync():
+        remote.fetch(path, depth=args.depth, filter_spec=args.filter_spec)
     print(f"fetch from {path}")
 
 
@@ -346,10 +407,53 @@ def push(args):
     print(f"push {args.branch} to {args.remote_path}")
 
 
+def run_daemon(args):
+    daemon.serve(args.base_path, args.host, args.port)
+
+
 def add(args):
-    base.add(args.paths)
+    with data.batch_fsync():
+        base.add(args.paths, jobs=args.jobs)
 
 
 def revert(args):
     base.revert(args.commit)
     print(f"revert to {args.commit[:10]}")
+
+
+def repack(args):
+    # bitmaps need every object in one pack
+    all_objects = args.all or args.write_bitmap
+    # paths find better deltas, but cost a walk of all the trees
+    paths = base.get_object_paths() if all_objects else None
+    packed = data.repack(all_objects=all_objects, paths=paths)
+    if packed is None:
+        print("nothing to repack")
+        return
+    name, count, _ = packed
+    print(f"pack {count} objects into {name}")
+    if args.write_bitmap:
+        bitmap_count = base.write_bitmaps(name)
+        print(f"write {bitmap_count} bitmaps for {name}")
+
+
+def gc(args):
+    result = base.gc(expire_seconds=args.expire)
+    if result.pack:
+        print(f"pack {result.packed} objects into {result.pack}")
+    print(f"prune {result.pruned} objects, delete {result.freed} bytes of loose objects and old packs")
+
+
+def prune(args):
+    count, freed = base.prune(expire_seconds=args.expire)
+    print(f"prune {count} objects, reclaim {freed} bytes")
+
+
+def pack_refs(args):
+    count = data.pack_refs()
+    print(f"pack {count} refs into packed-refs")
+
+
+def commit_graph(args):
+    count = base.write_commit_graph()
+    print(f"write commit-graph with {count} commits")
@@ -0,0 +1,143 @@
+# daemon module serve the repos under one base dir over the protocol in
+# protocol.py, for `rgit daemon`. it is one asyncio loop: a slow client only
+# holds its own connection, and object streaming of many clients interleave.
+#
+# the repo code works on the global data.RGIT_DIR, so every piece of repo work
+# runs inside switch_rgit_dir without awaiting, and we only await (network)
+# outside of it
+import os
+import asyncio
+from src import data, base, protocol, remote
+
+
+# turn the path a client asked for into a repo dir under base_dir,
+# refuse anything outside of it
+def _resolve_repo(base_dir: str, path: str) -> str:
+    base_dir = os.path.realpath(base_dir)
+    repo_path = os.path.realpath(os.path.join(base_dir, path))
+    if os.path.commonpath([base_dir, repo_path]) != base_dir:
+        raise ValueError(f"{path} is outside of the served dir")
+    if not os.path.isdir(os.path.join(repo_path, ".rgit")):
+        raise ValueError(f"{path} is not an rgit repository")
+    return repo_path
+
+
+def _get_branches(repo_path: str) -> dict[str, data.RefValue]:
+    with data.switch_rgit_dir(repo_path):
+        data.forget_resolved_refs() # another process may have moved them
+        return {ref: ref_value for ref, ref_value in data.iter_refs(prefix="heads")}
+
+
+async def _serve_fetch(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, repo_path: str) -> None:
+    protocol.write_refs(writer, _get_branches(repo_path))
+    await writer.drain()
+
+    wants: set[str] = set()
+    haves: set[str] = set()
+    depth, blobs = None, True
+    while True:
+        kind, payload = await protocol.expect_frame(
+            reader, protocol.DEPTH, protocol.FILTER, protocol.WANT, protocol.HAVE, protocol.DONE)
+        if kind == protocol.DONE:
+            break
+        if kind == protocol.DEPTH:
+            depth = int(payload)
+            continue
+        if kind == protocol.FILTER:
+            if payload.decode() not in remote.FILTER_SPECS:
+                raise ValueError(f"unknown filter {payload.decode()}")
+            blobs = False
+            continue
+        (wants if kind == protocol.WANT else haves).add(payload.decode())
+
+    with data.switch_rgit_dir(repo_path):
+        for oid in wants:
+            if not data.object_exists(oid):
+                raise ValueError(f"we don't have {oid}")
+        haves = {oid for oid in haves if data.object_exists(oid)}
+        oids = list(base.iter_objects_in_commits(
+            wants, exclude=haves, depth=depth, blobs=blobs)) if wants else []
+        cut = base.get_shallow_cut(wants, oids, depth)
+    for oid in sorted(cut):
+        protocol.write_frame(writer, protocol.SHALLOW, oid.encode())
+    await protocol.send_objects(writer, repo_path, oids)
+
+
+async def _serve_push(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, repo_path: str) -> None:
+    protocol.write_refs(writer, _get_branches(repo_path))
+    await writer.drain()
+
+    _, payload = await protocol.expect_frame(reader, protocol.UPDATE)
+    old_oid, new_oid, ref = payload.decode().split(" ", 2)
+    old_oid = "" if old_oid == "-" else old_oid
+    if not ref.startswith(os.path.join("refs", "heads", "")) or ".." in ref.split("/"):
+        raise ValueError(f"can't push to {ref}")
+    await protocol.receive_objects(reader, repo_path)
+
+    with data.switch_rgit_dir(repo_path):
+        if not data.object_exists(new_oid):
+            raise ValueError(f"push didn't send {new_oid}")
+        # somebody else may have pushed since we advertised the refs
+        data.forget_resolved_refs()
+        current = data.get_ref_value(ref)
+        current_oid = current.value if current else ""
+        if current_oid != old_oid:
+            raise ValueError(f"{ref} moved to {current_oid[:10]}, fetch first")
+        data.update_ref(ref, data.RefValue(symbolic=False, value=new_oid))
+    protocol.write_frame(writer, protocol.OK)
+    await writer.drain()
+
+
+# answer each WANT as soon as it arrives, the client pipelines them
+async def _serve_objects(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, repo_path: str) -> None:
+    while True:
+        kind, payload = await protocol.expect_frame(reader, protocol.WANT, protocol.DONE)
+        if kind == protocol.DONE:
+            break
+        with data.switch_rgit_dir(repo_path):
+            protocol.write_object(writer, payload.decode())
+        await protocol.drain(writer)
+    protocol.write_frame(writer, protocol.DONE)
+    await writer.drain()
+
+
+_COMMANDS = {
+    "fetch": _serve_fetch,
+    "push": _serve_push,
+    "objects": _serve_objects,
+}
+
+
+async def _handle(base_dir: str, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        _, payload = await protocol.expect_frame(reader, protocol.COMMAND)
+        command, path = payload.decode().split(" ", 1)
+        if command not in _COMMANDS:
+            raise ValueError(f"unknown command {command}")
+        await _COMMANDS[command](reader, writer, _resolve_repo(base_dir, path))
+    except (ValueError, AssertionError, FileNotFoundError) as error:
+        protocol.write_frame(writer, protocol.ERROR, str(error).encode())
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass # the client went away
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+async def _serve(base_dir: str, host: str, port: int) -> None:
+    server = await asyncio.start_server(
+        lambda reader, writer: _handle(base_dir, reader, writer), host, port)
+    addresses = ", ".join(str(sock.getsockname()) for sock in server.sockets)
+    print(f"serving {os.path.abspath(base_dir)} on {addresses}", flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+def serve(base_dir: str, host: str, port: int) -> None:
+    try:
+        asyncio.run(_serve(base_dir, host, port))
+    except KeyboardInterrupt:
+        pass
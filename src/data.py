@@ -3,15 +3,59 @@ import hashlib
 import sys
 import shutil
 import json
-from typing import Iterator, Tuple, Set, Generator, Dict
-from collections import namedtuple
+import zlib
+import mmap
+import struct
+import tempfile
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Iterator, Iterable, Tuple, Set, FrozenSet, Generator, Dict, BinaryIO, Callable, TypeVar, cast
+from collections import namedtuple, OrderedDict
+from collections.abc import MutableMapping
 from contextlib import contextmanager
+from src import pack
+
+try: # for reflinks, only on unix
+    import fcntl
+except ImportError:
+    fcntl = None # type: ignore
 
 RGIT_DIR = "" # will be set in cli.main()
 SYMREF_PREFIX = "ref: "
+CHUNK_SIZE = 1 << 20 # read big files 1 MiB at a time
+# loose objects favor speed (like git's core.looseCompression), packs get the default
+LOOSE_COMPRESSION_LEVEL = zlib.Z_BEST_SPEED
+# fetch/push: fewer objects than this are copied loose, more go in one pack
+UNPACK_LIMIT = 100
+TRANSFER_JOBS = 8 # threads reading objects while we transfer (it's I/O)
+TRANSFER_BATCH_SIZE = 256
+FICLONE = 0x40049409 # linux ioctl to clone a file's extents (reflink)
+# raw bytes of parsed commits and trees we keep around in one process
+PARSED_CACHE_BYTES = 32 << 20
+# how durable our writes are (RGIT_FSYNC):
+# - "on": each object, pack, index and ref is fsynced before it's renamed in
+# - "batch" (default): the same, except inside batch_fsync() (add, commit,
+#   fetch), where loose objects are fsynced all at once at the end
+# - "off": never fsync (throwaway repos, tests)
+FSYNC_MODES = ("on", "batch", "off")
+FSYNC_MODE = os.environ.get("RGIT_FSYNC", "batch")
+assert FSYNC_MODE in FSYNC_MODES, f"RGIT_FSYNC must be one of {', '.join(FSYNC_MODES)}"
+
+T = TypeVar("T")
 
 # a quick way to write a class with only attributes
 RefValue = namedtuple("RefValue", ["symbolic", "value"])
+# one file in the index: its blob oid + the stat data we saw when we hashed it,
+# so next time we can tell the file didn't change without reading it.
+# times are in ns, an entry with mtime 0 has no usable stat data
+IndexEntry = namedtuple(
+    "IndexEntry", ["oid", "mtime", "ctime", "size", "inode", "mode"],
+    defaults=[0, 0, 0, 0, 0]
+)
+
+# packs we already mapped for each rgit dir: RGIT_DIR -> (pack dir mtime, packs)
+_loaded_packs: Dict[str, Tuple[int, list[pack.Pack]]] = {}
 
 
 @contextmanager # only ONE function below this line is wrapped
@@ -36,41 +80,617 @@ def clear():
     shutil.rmtree(RGIT_DIR)
 
 
-# get file content, hash it with object type, then put the content in .rgit/objects/<hash>
-def hash_object(file_content: bytes, type_: str ="blob") -> str:
-    # prepend the type to the content
-    file_content = type_.encode() + b"\0" + file_content
-    hasher = hashlib.sha1(file_content) # create hasher + put message to hash
-    object_id = hasher.hexdigest() # hash
+# get file content, hash it with object type, then put the content in .rgit/objects/<hash>.
+# we know the oid before writing, so an object we already have is never written.
+# use write = False to just compute the oid without storing the object
+def hash_object(file_content: bytes, type_: str ="blob", write: bool = True) -> str:
+    object_id = hashlib.sha1(type_.encode() + b"\0" + file_content).hexdigest()
+    if not write or _freshen_object(object_id):
+        return object_id
+    return _write_object_chunks([file_content], type_)
+
 
-    target_path = f"{RGIT_DIR}/objects/{object_id}"
-    with open(target_path, "wb") as file:
-        # prepend the object type
-        file.write(file_content)
+# same as hash_object, but read the content from a binary file handle in chunks
+# so we never hold a whole big file in memory.
+# use write = False to just compute the oid without storing the object
+def hash_file(file: BinaryIO, type_: str = "blob", write: bool = True) -> str:
+    chunks = iter(lambda: file.read(CHUNK_SIZE), b"")
+    if not write:
+        hasher = hashlib.sha1(type_.encode() + b"\0")
+        for chunk in chunks:
+            hasher.update(chunk)
+        return hasher.hexdigest()
+    return _write_object_chunks(chunks, type_)
+
+
+# hash "type\0content" and zlib-compress it into a temp file chunk by chunk,
+# we only know the oid at the end, so then we rename the temp file to it
+# (or drop it, if we had the object already).
+# note that the oid is over the uncompressed bytes, compression is just storage
+def _write_object_chunks(chunks: Iterable[bytes], type_: str) -> str:
+    header = type_.encode() + b"\0"
+    hasher = hashlib.sha1(header) # create hasher + put message to hash
+    compressor = zlib.compressobj(LOOSE_COMPRESSION_LEVEL)
+
+    objects_dir = os.path.join(RGIT_DIR, "objects")
+    fd, temp_path = tempfile.mkstemp(dir=objects_dir, prefix="tmp-obj-")
+    try:
+        with os.fdopen(fd, "wb") as temp_file:
+            temp_file.write(compressor.compress(header))
+            for chunk in chunks:
+                hasher.update(chunk)
+                temp_file.write(compressor.compress(chunk))
+            temp_file.write(compressor.flush())
+        object_id = hasher.hexdigest() # hash
+        if _freshen_object(object_id):
+            os.remove(temp_path)
+        else:
+            move_into_place(temp_path, _loose_object_path(object_id), batch=True)
+    except BaseException:
+        os.remove(temp_path)
+        raise
 
     return object_id
 
 
+# loose objects live in objects/<first 2 hex>/<other 38 hex>, so the 256 dirs
+# work as a fanout: objects with a given prefix are all in one small dir
+def _loose_object_path(oid: str) -> str:
+    return os.path.join(RGIT_DIR, "objects", oid[:2], oid[2:])
+
+
+# old rgit wrote loose objects flat into objects/<oid>
+def _legacy_object_path(oid: str) -> str:
+    return os.path.join(RGIT_DIR, "objects", oid)
+
+
+# return where the loose object is stored, None if it isn't loose
+def _find_loose_object(oid: str) -> str | None:
+    if _batch_files: # not renamed in yet
+        temp_path = _batch_files.get(_loose_object_path(oid))
+        if temp_path is not None:
+            return temp_path
+    for path in (_loose_object_path(oid), _legacy_object_path(oid)):
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def _pack_dir() -> str:
+    return os.path.join(RGIT_DIR, "objects", "pack")
+
+
+# write an already hashed object ("type\0content"), e.g. one copied from a remote
+def _write_loose_object(oid: str, raw: bytes) -> None:
+    _write_loose_file(_loose_object_path(oid), raw)
+
+
+# write through a temp file, an object file may be hardlinked into another
+# repo so we never write into an existing one
+def _write_loose_file(path: str, raw: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix="tmp-obj-")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(zlib.compress(raw, LOOSE_COMPRESSION_LEVEL))
+        move_into_place(temp_path, path, batch=True)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+# True if we have the object already. a loose one gets its mtime bumped, we
+# are about to point at it again, so prune's grace period starts over
+def _freshen_object(oid: str) -> bool:
+    path = _find_loose_object(oid)
+    if path is not None:
+        try:
+            os.utime(path)
+        except OSError:
+            pass # e.g. hardlinked from a repo we can't write
+        return True
+    return any(pack.contains(object_pack, oid) for object_pack in _get_packs())
+
+
+# final path -> temp file of the loose objects written in the current
+# batch_fsync(), None when there is no batch
+_batch_files: Dict[str, str] | None = None
+_batch_lock = threading.Lock() # add writes objects from threads
+
+
+def _fsync_path(path: str) -> None:
+    fd = os.open(path, os.O_RDONLY) # a dir can't be opened for writing
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# rename a fully written temp file to its final path. the data is fsynced
+# before the name points at it, so a crash never leave a truncated file under a
+# valid name, then the dir, so the rename itself is on disk.
+# in a batch (batch=True writes only), it's left for flush_batch
+def move_into_place(temp_path: str, path: str, batch: bool = False) -> None:
+    if FSYNC_MODE == "off":
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+        return
+    if batch and _batch_files is not None:
+        with _batch_lock:
+            if path not in _batch_files: # two threads wrote the same object
+                _batch_files[path] = temp_path
+                return
+        os.remove(temp_path)
+        return
+    _fsync_path(temp_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(temp_path, path)
+    _fsync_path(os.path.dirname(path))
+
+
+@contextmanager # only ONE function below this line is wrapped
+# write the loose objects of a whole command with one fsync pass: until the
+# end, objects stay in their temp files (readers find them through
+# _batch_files), then flush_batch makes them all durable at once
+def batch_fsync() -> Iterator[None]:
+    global _batch_files
+    if FSYNC_MODE != "batch" or _batch_files is not None:
+        yield # nothing to batch, or we're in a batch already
+        return
+    _batch_files = {}
+    try:
+        yield
+    finally:
+        try:
+            flush_batch()
+        finally:
+            _batch_files = None
+
+
+# fsync every file of the batch, rename them all in, then fsync each dir we
+# renamed into once. the fsyncs run from threads: the fs commits the ones that
+# wait at the same time together, instead of one disk flush each.
+# called before any ref or index update too, so those never point at an
+# object that isn't on disk yet
+def flush_batch() -> None:
+    if not _batch_files:
+        return
+    with _batch_lock:
+        files = list(_batch_files.items())
+        _batch_files.clear()
+    with ThreadPoolExecutor(max_workers=TRANSFER_JOBS) as executor:
+        list(executor.map(_fsync_path, [temp_path for _, temp_path in files]))
+        dirs = set()
+        for path, temp_path in files:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+            dirs.add(os.path.dirname(path))
+        list(executor.map(_fsync_path, dirs))
+
+
+# read a loose object and return its uncompressed bytes ("type\0content")
+def _read_loose_object(path: str) -> bytes:
+    with open(path, "rb") as file:
+        stored = file.read()
+    try:
+        return zlib.decompress(stored)
+    except zlib.error:
+        # objects written before we compressed are stored raw
+        return stored
+
+
+# return the packs of the current rgit dir. we map them once, and only map
+# again when the pack dir was changed (e.g. another process repacked)
+def _get_packs(recheck: bool = False) -> list[pack.Pack]:
+    loaded = _loaded_packs.get(RGIT_DIR)
+    if loaded is not None and not recheck:
+        return loaded[1]
+
+    pack_dir = _pack_dir()
+    mtime = os.stat(pack_dir).st_mtime_ns if os.path.isdir(pack_dir) else 0
+    if loaded is not None and loaded[0] == mtime:
+        return loaded[1]
+
+    packs = [pack.load_pack(pack_dir, name) for name in pack.iter_pack_names(pack_dir)]
+    _loaded_packs[RGIT_DIR] = (mtime, packs)
+    return packs
+
+
+def get_packs() -> list[pack.Pack]:
+    return _get_packs()
+
+
+# get the whole stored object ("type\0content") from packs first, then loose
+# objects. return None if we don't have it.
+def _read_raw_object(oid: str, fetch_promised: bool = True) -> bytes | None:
+    for recheck in (False, True):
+        for object_pack in _get_packs(recheck):
+            raw = pack.read_object(object_pack, oid)
+            if raw is not None:
+                return raw
+
+        path = _find_loose_object(oid)
+        if path is not None:
+            return _read_loose_object(path)
+
+    # a partial clone don't have every blob, its promisor remote does
+    if fetch_promised and fetch_promised_objects([oid]):
+        return _read_raw_object(oid, fetch_promised=False)
+    return None
+
+
+# the whole stored object ("type\0content"), to send it to another repo
+def get_raw_object(oid: str) -> bytes:
+    raw = _read_raw_object(oid)
+    if raw is None:
+        raise FileNotFoundError(f"object {oid} not found")
+    return raw
+
+
 # get the oid and expected type, return if found + has expected type
 def get_object_content(oid: str, expected: str | None = "blob") -> bytes:
-    # read in binary mode
-    with open(f"{RGIT_DIR}/objects/{oid}", 'rb') as file:
+    raw = _read_raw_object(oid)
+    if raw is None:
+        raise FileNotFoundError(f"object {oid} not found")
+
+    # get the type first
+    # this function divide bytes into 3 parts, before - first_sep - after
+    type_, _, content = raw.partition(b"\0")
+    type_str = type_.decode()
+    if expected is not None:
+        assert type_str == expected, f"Expected {expected} type, found {type_str}"
+    return content
 
-        # get the type first
-        # this function divide bytes into 3 parts, before - first_sep - after
-        type_, _, content = file.read().partition(b"\0")
-        type_str = type_.decode()
+
+# like get_object_content, but yield the content in chunks. a loose object is
+# decompressed while we read it, so a big blob is never whole in memory
+def iter_object_content(oid: str, expected: str | None = "blob") -> Iterator[bytes]:
+    path = _find_loose_object(oid)
+    try:
+        if path is None:
+            raise FileNotFoundError(oid)
+        file = open(path, "rb")
+    except FileNotFoundError: # packed (or missing), just read it whole
+        yield get_object_content(oid, expected)
+        return
+
+    with file:
+        decompressor = zlib.decompressobj()
+        head = b""
+        try:
+            # decompress until we get the whole "type\0" header
+            while b"\0" not in head:
+                chunk = file.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                head += decompressor.decompress(chunk)
+        except zlib.error:
+            # stored raw by an old rgit
+            yield get_object_content(oid, expected)
+            return
+
+        type_, _, content = head.partition(b"\0")
         if expected is not None:
-            assert type_str == expected, f"Expected {expected} type, found {type_str}"
-        return content
+            assert type_.decode() == expected, f"Expected {expected} type, found {type_.decode()}"
+        yield content
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            yield decompressor.decompress(chunk)
+        yield decompressor.flush()
+
+
+# an LRU of parsed commits and trees, in front of get_object_content. objects
+# never change, so an entry is never stale; we only have to keep memory bounded.
+# the cost of an entry is the size of its raw content (the parsed python
+# objects take a few times that)
+class ObjectCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Tuple[str, str], Tuple[object, int]] = OrderedDict()
+        self._lock = threading.Lock() # add and checkout read objects from threads
+
+    def get(self, oid: str, type_: str, parse: Callable[[bytes], T]) -> T:
+        key = (oid, type_)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return cast(T, entry[0])
+            self.misses += 1
+
+        content = get_object_content(oid, expected=type_)
+        value = parse(content)
+        cost = len(content)
+        if cost > self.max_bytes:
+            return value
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (value, cost)
+                self.size += cost
+            while self.size > self.max_bytes:
+                _, (_, old_cost) = self._entries.popitem(last=False)
+                self.size -= old_cost
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+parsed_objects = ObjectCache(PARSED_CACHE_BYTES)
+
+
+# get a commit/tree through the cache, parse is only called on a miss
+def get_parsed_object(oid: str, type_: str, parse: Callable[[bytes], T]) -> T:
+    return parsed_objects.get(oid, type_, parse)
+
+
+def _parse_tree_entries(content: bytes) -> Tuple[Tuple[str, str, str], ...]:
+    entries = []
+    for line in content.decode().splitlines():
+        type_, oid, name = line.split(" ", 2)
+        entries.append((type_, oid, name))
+    return tuple(entries)
+
+
+# the content of a tree object with these (type, oid, name) entries
+def format_tree(entries: Iterable[Tuple[str, str, str]]) -> bytes:
+    return "".join(f"{type_} {oid} {name}\n" for type_, oid, name in sorted(entries)).encode()
+
+
+# (type, oid, name) of every entry in a tree, parsed once per process
+def get_tree_entries(oid: str) -> Tuple[Tuple[str, str, str], ...]:
+    return get_parsed_object(oid, "tree", _parse_tree_entries)
+
+
+def _is_oid(name: str) -> bool:
+    return len(name) == 40 and all(ch in "0123456789abcdef" for ch in name)
+
+
+def _is_shard(name: str) -> bool:
+    return len(name) == 2 and all(ch in "0123456789abcdef" for ch in name)
+
+
+# yield the oid of every loose object, sharded or legacy flat ones
+def iter_loose_objects() -> Iterator[str]:
+    with os.scandir(os.path.join(RGIT_DIR, "objects")) as entries:
+        for entry in entries:
+            if _is_oid(entry.name) and entry.is_file():
+                yield entry.name
+            elif _is_shard(entry.name) and entry.is_dir():
+                for name in os.listdir(entry.path):
+                    if _is_oid(entry.name + name):
+                        yield entry.name + name
+
+
+# move the flat objects an old rgit wrote into their shard dirs. after this
+# the objects dir only holds the shards (+ pack, info), so it's cheap to list.
+# it renames files other processes may be reading, so only gc does it
+def shard_legacy_objects() -> None:
+    with os.scandir(os.path.join(RGIT_DIR, "objects")) as entries:
+        legacy_oids = [entry.name for entry in entries if _is_oid(entry.name) and entry.is_file()]
+    for oid in legacy_oids:
+        path = _loose_object_path(oid)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(_legacy_object_path(oid), path)
+
+
+MIN_PREFIX_LENGTH = 4
+
+
+# return every oid we have that starts with prefix (sorted), looking only at
+# one shard dir, a binary search in each pack index, and the legacy flat
+# objects (the objects dir itself is small once gc sharded them)
+def find_objects_by_prefix(prefix: str) -> list[str]:
+    prefix = prefix.lower()
+    if len(prefix) < MIN_PREFIX_LENGTH or not all(ch in "0123456789abcdef" for ch in prefix):
+        return []
+
+    found: Set[str] = set()
+    for object_pack in _get_packs(recheck=True):
+        found.update(pack.iter_oids_with_prefix(object_pack, prefix))
+
+    shard_dir = os.path.join(RGIT_DIR, "objects", prefix[:2])
+    if os.path.isdir(shard_dir):
+        for name in os.listdir(shard_dir):
+            oid = prefix[:2] + name
+            if _is_oid(oid) and oid.startswith(prefix):
+                found.add(oid)
+    with os.scandir(os.path.join(RGIT_DIR, "objects")) as entries:
+        found.update(entry.name for entry in entries
+            if entry.name.startswith(prefix) and _is_oid(entry.name) and entry.is_file())
+    return sorted(found)
+
+
+# move every loose object into a new pack, return (pack name, object count,
+# bytes of the loose objects and old packs deleted) or None if there was
+# nothing to pack. with all_objects, the objects of the
+# old packs go into the new one too and the old packs are deleted.
+# with keep (gc), only those objects are packed: other loose objects stay
+# loose, and the ones in old packs are written loose, so prune decides about
+# them with the same grace period.
+# similar objects are stored as deltas, paths (oid -> path) help find them
+def repack(
+    all_objects: bool = False,
+    keep: Set[str] | None = None,
+    paths: Dict[str, str] | None = None
+) -> Tuple[str, int, int] | None:
+    loose_paths: Dict[str, str] = {} # oid -> its loose file
+    for oid in sorted(iter_loose_objects()):
+        if keep is not None and oid not in keep:
+            continue
+        path = _find_loose_object(oid)
+        if path is not None:
+            loose_paths[oid] = path
+    old_packs = _get_packs(recheck=True) if all_objects else []
+    if not loose_paths and not old_packs:
+        return None
+
+    def iter_raw_objects() -> Iterator[Tuple[str, bytes]]:
+        for oid, path in loose_paths.items():
+            yield (oid, _read_loose_object(path))
+        for old_pack in old_packs:
+            for oid in pack.iter_oids(old_pack):
+                if keep is not None and oid not in keep:
+                    continue
+                raw = pack.read_object(old_pack, oid)
+                assert raw is not None
+                yield (oid, raw)
+
+    name = pack.write_pack(_pack_dir(), iter_raw_objects(), window=pack.DELTA_WINDOW, paths=paths,
+        durable=FSYNC_MODE != "off")
+    new_packs = _get_packs(recheck=True) # the new pack has to be visible before we delete
+    freed = sum(_remove_file(path) for path in loose_paths.values())
+    for old_pack in old_packs:
+        if old_pack.name == name: # nothing changed, we wrote the same pack again
+            continue
+        if keep is not None:
+            _unpack_objects(old_pack, keep)
+        for ext in (".idx", ".pack", ".bitmap"):
+            try:
+                freed += _remove_file(os.path.join(_pack_dir(), old_pack.name + ext))
+            except FileNotFoundError:
+                pass
+    _get_packs(recheck=True)
+
+    count = next(new_pack.count for new_pack in new_packs if new_pack.name == name)
+    return (name, count, freed)
+
+
+# delete a file, return the bytes it freed: none if it's hardlinked into
+# another repo (local fetch), the data is still there
+def _remove_file(path: str) -> int:
+    stat = os.lstat(path)
+    os.remove(path)
+    return stat.st_size if stat.st_nlink == 1 else 0
+
+
+# write the objects of a pack that aren't in keep as loose objects. they get
+# the pack's mtime, so their grace period counts from when they were packed
+def _unpack_objects(object_pack: pack.Pack, keep: Set[str]) -> None:
+    mtime = os.stat(os.path.join(_pack_dir(), object_pack.name + ".pack")).st_mtime
+    for oid in pack.iter_oids(object_pack):
+        if oid in keep or _find_loose_object(oid) is not None:
+            continue
+        raw = pack.read_object(object_pack, oid)
+        assert raw is not None
+        _write_loose_object(oid, raw)
+        path = _find_loose_object(oid) # may be in a batch still
+        assert path is not None, f"object {oid} not found right after it was written"
+        os.utime(path, (mtime, mtime))
+
+
+# delete every loose object not in keep whose mtime is before expire (a unix
+# time), and the temp files a crashed write left behind, then the shard dirs
+# that are empty. return (objects deleted, bytes freed). we only stat what we
+# may delete, so the cost is a listing of each shard dir + the garbage.
+# a file hardlinked into another repo (local fetch) frees nothing here
+def prune_loose_objects(keep: Set[str], expire: float) -> Tuple[int, int]:
+    count = freed = 0
+
+    def prune_dir(dir_path: str, shard: str | None) -> None:
+        nonlocal count, freed
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                oid = (shard or "") + entry.name
+                is_object = shard is not None and _is_oid(oid)
+                if not (is_object and oid not in keep) and not entry.name.startswith("tmp-"):
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+                if not entry.is_file(follow_symlinks=False) or stat.st_mtime >= expire:
+                    continue
+                os.remove(entry.path)
+                count += is_object
+                freed += stat.st_size if stat.st_nlink == 1 else 0
+
+    objects_dir = os.path.join(RGIT_DIR, "objects")
+    prune_dir(objects_dir, "") # legacy flat objects
+    if os.path.isdir(_pack_dir()):
+        prune_dir(_pack_dir(), None) # only temp files
+    with os.scandir(objects_dir) as entries:
+        shard_dirs = [entry.path for entry in entries if _is_shard(entry.name) and entry.is_dir()]
+    for shard_dir in shard_dirs:
+        prune_dir(shard_dir, os.path.basename(shard_dir))
+        try:
+            os.rmdir(shard_dir)
+        except OSError:
+            pass # not empty
+    return (count, freed)
+
+
+# packed-refs hold many refs in one sorted file, one "<oid> <ref>" per line.
+# a loose ref file always win over the packed one with the same name
+PACKED_REFS_HEADER = "# rgit packed-refs\n"
+
+# packed refs we already read for each rgit dir: RGIT_DIR -> (mtime, size, refs)
+_loaded_packed_refs: Dict[str, Tuple[int, int, Dict[str, str]]] = {}
+# resolved refs for each rgit dir: RGIT_DIR -> {(ref, deref): result}.
+# refs only change through update_ref/delete_ref/pack_refs, which clear it
+_resolved_refs: Dict[str, Dict[Tuple[str, bool], Tuple[str, RefValue | None]]] = {}
+
+
+def _packed_refs_path() -> str:
+    return os.path.join(RGIT_DIR, "packed-refs")
+
+
+def _get_packed_refs() -> Dict[str, str]:
+    try:
+        stat = os.stat(_packed_refs_path())
+    except FileNotFoundError:
+        return {}
+    loaded = _loaded_packed_refs.get(RGIT_DIR)
+    if loaded is not None and loaded[:2] == (stat.st_mtime_ns, stat.st_size):
+        return loaded[2]
+
+    refs = {}
+    with open(_packed_refs_path(), "r") as packed_file:
+        for line in packed_file:
+            if line.startswith("#") or not line.strip():
+                continue
+            oid, ref = line.rstrip("\n").split(" ", 1)
+            refs[ref] = oid
+    _loaded_packed_refs[RGIT_DIR] = (stat.st_mtime_ns, stat.st_size, refs)
+    return refs
+
+
+def _write_packed_refs(refs: Dict[str, str]) -> None:
+    flush_batch()
+    temp_path = _packed_refs_path() + ".tmp"
+    with open(temp_path, "w") as packed_file:
+        packed_file.write(PACKED_REFS_HEADER)
+        packed_file.write("".join(f"{refs[ref]} {ref}\n" for ref in sorted(refs)))
+    move_into_place(temp_path, _packed_refs_path())
+    _loaded_packed_refs.pop(RGIT_DIR, None)
+
+
+# a long running process (rgit daemon) calls this to see refs changed by others
+def forget_resolved_refs() -> None:
+    _resolved_refs.pop(RGIT_DIR, None)
 
 
 # get ref name and trace it back until the non-symbolic ref. Return that ref and the value
 # use deref = False if just want to get value of exact ref
 def _get_ref_internal(ref: str, deref: bool = True) -> Tuple[str, RefValue | None]:
+    resolved = _resolved_refs.setdefault(RGIT_DIR, {})
+    key = (ref, deref)
+    if key not in resolved:
+        resolved[key] = _resolve_ref(ref, deref)
+    return resolved[key]
+
+
+def _resolve_ref(ref: str, deref: bool) -> Tuple[str, RefValue | None]:
     target_path = os.path.join(RGIT_DIR, ref)
-    if not os.path.isfile(target_path): # return zero value if file doesn't exist
-        return (ref, None)
+    if not os.path.isfile(target_path):
+        # not loose, maybe it's packed. return zero value if not there either
+        packed_oid = _get_packed_refs().get(ref)
+        if packed_oid is None:
+            return (ref, None)
+        return (ref, RefValue(symbolic=False, value=packed_oid))
 
     with open(target_path, "r") as reffile:
         ref_content = reffile.read().strip()
@@ -102,8 +722,14 @@ def update_ref(ref: str, ref_value: RefValue, deref: bool = True) -> None:
     else:
         updated_value = ref_value.value
 
-    with open(target_path, "w") as reffile:
+    # the loose file shadows the packed value, so packed-refs stay as it is.
+    # the objects it may point at go to disk first, the ref never get truncated
+    flush_batch()
+    temp_path = target_path + ".lock"
+    with open(temp_path, "w") as reffile:
         reffile.write(updated_value)
+    move_into_place(temp_path, target_path)
+    forget_resolved_refs()
 
 
 # get the ref name find the value of the ref in .rgit/
@@ -118,12 +744,17 @@ def get_ref_value(ref: str, deref: bool = True) -> RefValue | None:
 def iter_refs(deref: bool = True, prefix: str = "") -> Iterator[Tuple[str, RefValue]]:
     refs = ["HEAD", "MERGE_HEAD"] if not prefix else []
 
+    ref_names = set()
     start_path = os.path.join(RGIT_DIR, "refs", prefix)
     for root, _, filenames in os.walk(start_path):
         # root form os.walk is absolute, but all our functionality need relative
         root = os.path.relpath(root, RGIT_DIR)
         for filename in filenames:
-            refs.append(os.path.join(root, filename))
+            ref_names.add(os.path.join(root, filename))
+
+    packed_prefix = os.path.join("refs", prefix, "")
+    ref_names.update(ref for ref in _get_packed_refs() if ref.startswith(packed_prefix))
+    refs.extend(sorted(ref_names))
 
     for ref in refs:
         ref_hash = get_ref_value(ref, deref=deref)
@@ -140,40 +771,475 @@ def delete_ref(ref: str) -> None:
         # if the file already doesn't exist, it should be fine
         pass
 
+    packed_refs = _get_packed_refs()
+    if ref in packed_refs:
+        _write_packed_refs({name: oid for name, oid in packed_refs.items() if name != ref})
+    forget_resolved_refs()
+
+
+# move every loose (non-symbolic) ref under refs/ into packed-refs, return the count
+def pack_refs() -> int:
+    packed_refs = dict(_get_packed_refs())
+    loose_refs = []
+    for root, _, filenames in os.walk(os.path.join(RGIT_DIR, "refs")):
+        root = os.path.relpath(root, RGIT_DIR)
+        for filename in filenames:
+            ref = os.path.join(root, filename)
+            _, ref_value = _get_ref_internal(ref, deref=False)
+            # a ref with no commit yet (new master) has no oid to pack
+            if ref_value is None or ref_value.symbolic or not ref_value.value:
+                continue
+            packed_refs[ref] = ref_value.value
+            loose_refs.append(ref)
+
+    _write_packed_refs(packed_refs)
+    for ref in loose_refs:
+        os.remove(os.path.join(RGIT_DIR, ref))
+    forget_resolved_refs()
+    return len(loose_refs)
+
+
+# a shallow repo (fetch --depth) lacks the history below some commits. the
+# shallow file lists those cut points, one oid per line: we act as if they had
+# no parents. it only changes through write_shallow
+_loaded_shallow: Dict[str, FrozenSet[str]] = {}
+
+
+def _shallow_path() -> str:
+    return os.path.join(RGIT_DIR, "shallow")
+
+
+def get_shallow() -> FrozenSet[str]:
+    shallow = _loaded_shallow.get(RGIT_DIR)
+    if shallow is None:
+        try:
+            with open(_shallow_path(), "r") as shallow_file:
+                shallow = frozenset(line.strip() for line in shallow_file if line.strip())
+        except FileNotFoundError:
+            shallow = frozenset()
+        _loaded_shallow[RGIT_DIR] = shallow
+    return shallow
+
+
+# replace the cut points, no cut points = a complete repo, no file
+def write_shallow(oids: Iterable[str]) -> None:
+    oids = sorted(set(oids))
+    if oids:
+        flush_batch()
+        temp_path = _shallow_path() + ".tmp"
+        with open(temp_path, "w") as shallow_file:
+            shallow_file.write("".join(f"{oid}\n" for oid in oids))
+        move_into_place(temp_path, _shallow_path())
+    elif os.path.exists(_shallow_path()):
+        os.remove(_shallow_path())
+    _loaded_shallow.pop(RGIT_DIR, None)
+
+
+# a partial clone (fetch --filter=blob:none) got commits and trees but no blobs.
+# the promisor file holds the remote (a path or an url) it fetched from, which
+# promised to have them: we get a blob from there the first time we read it
+# checkout reads objects from threads. reentrant: a promisor can be partial too
+_promisor_lock = threading.RLock()
+
+
+def _promisor_path() -> str:
+    return os.path.join(RGIT_DIR, "promisor")
+
+
+def get_promisor() -> str | None:
+    try:
+        with open(_promisor_path(), "r") as promisor_file:
+            return promisor_file.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def set_promisor(remote: str) -> None:
+    with open(_promisor_path(), "w") as promisor_file:
+        promisor_file.write(f"{remote}\n")
+
+
+# get the objects we miss from the promisor remote, all in one go, return how
+# many we asked for (0 if we aren't a partial clone)
+def fetch_promised_objects(oids: Iterable[str]) -> int:
+    promisor = get_promisor()
+    if promisor is None:
+        return 0
+    with _promisor_lock:
+        missing = [oid for oid in dict.fromkeys(oids) if not object_exists(oid)]
+        if not missing:
+            return 0
+        if promisor.startswith("rgit://"):
+            from src import protocol # protocol imports this module
+            protocol.fetch_objects(promisor, missing)
+        else:
+            copy_objects(promisor, os.path.dirname(RGIT_DIR), missing)
+    return len(missing)
+
 
 def object_exists(oid: str) -> bool:
-    target_path = os.path.join(RGIT_DIR, "objects", oid)
-    return os.path.isfile(target_path)
+    if any(pack.contains(object_pack, oid) for object_pack in _get_packs()):
+        return True
+    if _find_loose_object(oid) is not None:
+        return True
+    # someone may have just packed it
+    return any(pack.contains(object_pack, oid) for object_pack in _get_packs(recheck=True))
 
-def fetch_object_if_missing(remote_path: str, oid: str) -> None:
-    if object_exists(oid):
-        return
 
-    shutil.copy(
-        os.path.join(remote_path, ".rgit", "objects", oid),
-        os.path.join(RGIT_DIR, "objects", oid)
-    )
+# where an object is stored: the path of a loose object, or the pack it is in
+def _locate_object(oid: str) -> str | pack.Pack | None:
+    for recheck in (False, True):
+        for object_pack in _get_packs(recheck):
+            if pack.contains(object_pack, oid):
+                return object_pack
+        path = _find_loose_object(oid)
+        if path is not None:
+            return path
+    return None
+
+
+def _read_located(oid: str, location: str | pack.Pack) -> bytes:
+    if isinstance(location, str):
+        return _read_loose_object(location)
+    raw = pack.read_object(location, oid)
+    assert raw is not None
+    return raw
 
 
-def push_object(remote_path: str, oid: str) -> None:
-    assert object_exists(oid), f"can't find oid {oid}"
-    shutil.copy(
-        os.path.join(RGIT_DIR, "objects", oid),
-        os.path.join(remote_path, ".rgit", "objects", oid)
+# hardlink a loose object into another repo, or reflink (copy-on-write clone)
+# it if the filesystem can't link. return False if neither worked
+def _link_object(source_path: str, target_path: str) -> bool:
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    try:
+        os.link(source_path, target_path)
+        return True
+    except FileExistsError:
+        return True
+    except OSError:
+        pass
+    if fcntl is None:
+        return False
+
+    temp_path = target_path + ".tmp"
+    try:
+        with open(source_path, "rb") as source, open(temp_path, "wb") as target:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        os.replace(temp_path, target_path)
+        return True
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+
+
+# read the objects on a thread pool a batch ahead of the caller, so reading
+# (and decompressing) the next batch overlaps writing this one
+def _iter_located_objects(
+    oids: list[str],
+    locations: Dict[str, str | pack.Pack]
+) -> Iterator[Tuple[str, bytes]]:
+    with ThreadPoolExecutor(max_workers=TRANSFER_JOBS) as executor:
+        pending: list[Tuple[str, Future[bytes]]] = []
+        for start in range(0, len(oids), TRANSFER_BATCH_SIZE):
+            batch = [(oid, executor.submit(_read_located, oid, locations[oid]))
+                for oid in oids[start:start + TRANSFER_BATCH_SIZE]]
+            for oid, future in pending:
+                yield (oid, future.result())
+            pending = batch
+        for oid, future in pending:
+            yield (oid, future.result())
+
+
+# copy objects from the repo at source_path to the one at target_path, skip the
+# ones it already has, return how many we copied.
+# - same filesystem: loose objects are hardlinked (or reflinked), no bytes copied
+# - the rest goes into the target as one pack, or as loose objects written on
+#   a thread pool if there are only a few (a pack per handful of objects would
+#   leave lots of tiny packs around)
+def copy_objects(source_path: str, target_path: str, oids: Iterable[str]) -> int:
+    oids = list(dict.fromkeys(oids)) # oids may be lazy, read them in the current repo
+    with switch_rgit_dir(target_path):
+        needed = [oid for oid in oids if not object_exists(oid)]
+        if not needed:
+            return 0
+        target_files = {oid: _loose_object_path(oid) for oid in needed}
+        target_objects_dir = os.path.join(RGIT_DIR, "objects")
+
+    with switch_rgit_dir(source_path):
+        # the source may be a partial clone itself
+        fetch_promised_objects(oid for oid in needed if _locate_object(oid) is None)
+        locations = {}
+        for oid in needed:
+            location = _locate_object(oid)
+            assert location is not None, f"can't find object {oid} in {source_path}"
+            locations[oid] = location
+        source_objects_dir = os.path.join(RGIT_DIR, "objects")
+
+    same_filesystem = os.stat(source_objects_dir).st_dev == os.stat(target_objects_dir).st_dev
+    to_copy = []
+    for oid in needed:
+        location = locations[oid]
+        if same_filesystem and isinstance(location, str) and _link_object(location, target_files[oid]):
+            continue
+        to_copy.append(oid)
+
+    if len(to_copy) >= UNPACK_LIMIT:
+        with switch_rgit_dir(target_path):
+            pack.write_pack(_pack_dir(), _iter_located_objects(to_copy, locations), durable=FSYNC_MODE != "off")
+            _get_packs(recheck=True)
+    else:
+        with ThreadPoolExecutor(max_workers=TRANSFER_JOBS) as executor:
+            def copy_one(oid: str) -> None:
+                _write_loose_file(target_files[oid], _read_located(oid, locations[oid]))
+            list(executor.map(copy_one, to_copy))
+    return len(needed)
+
+
+# store objects that arrive one at a time (e.g. from the network) into the
+# current repo. many objects go into one pack, written by a background thread
+# while we keep receiving, a few are written loose. the paths are taken when
+# it's created, so it keeps writing to the same repo after switch_rgit_dir
+class ObjectReceiver:
+    def __init__(self, count: int):
+        self.objects_dir = os.path.join(RGIT_DIR, "objects")
+        self.pack_name: str | None = None
+        self._error: BaseException | None = None
+        self._queue: queue.Queue[Tuple[str, bytes] | None] | None = None
+        self._thread: threading.Thread | None = None
+        if count >= UNPACK_LIMIT:
+            self._queue = queue.Queue(maxsize=TRANSFER_BATCH_SIZE)
+            self._thread = threading.Thread(target=self._write_pack, args=(_pack_dir(),))
+            self._thread.start()
+
+    def _write_pack(self, pack_dir: str) -> None:
+        assert self._queue is not None
+        try:
+            self.pack_name = pack.write_pack(pack_dir, iter(self._queue.get, None), durable=FSYNC_MODE != "off")
+        except BaseException as error:
+            self._error = error
+            for _ in iter(self._queue.get, None): pass # don't block the sender
+
+    # raw is "type\0content", we check it really hashes to oid
+    def add(self, oid: str, raw: bytes) -> None:
+        if hashlib.sha1(raw).hexdigest() != oid:
+            raise ValueError(f"received object {oid} is corrupt")
+        if self._queue is not None:
+            self._queue.put((oid, raw))
+        else:
+            _write_loose_file(os.path.join(self.objects_dir, oid[:2], oid[2:]), raw)
+
+    def close(self) -> None:
+        if self._queue is None or self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+
+def index_entry(oid: str, stat: os.stat_result) -> IndexEntry:
+    return IndexEntry(
+        oid=oid, mtime=stat.st_mtime_ns, ctime=stat.st_ctime_ns,
+        size=stat.st_size, inode=stat.st_ino, mode=stat.st_mode
     )
 
 
-# yield index file as a dict, let the caller deal with it
-# and then dump it back to save.
-@contextmanager
-def get_index() -> Iterator[Dict[str, str]]:
-    index = {} # in case we don't have .rgit/index
-    index_path = os.path.join(RGIT_DIR, "index")
-    if os.path.isfile(index_path):
-        with open(index_path, "r") as index_file:
-            index = json.load(index_file) # load into a dict
+# True if the file with this stat is surely still what the entry hashed
+def stat_matches(entry: IndexEntry, stat: os.stat_result) -> bool:
+    return entry.mtime != 0 and entry == index_entry(entry.oid, stat)
+
+
+# racy case: if a file was changed in the same timestamp tick the index was
+# written, it can change again later without its mtime moving. so we drop the
+# stat data of such entry and let the next reader hash the file again.
+def _smudge_racy(entry: IndexEntry, index_mtime: int) -> IndexEntry:
+    if entry.mtime >= index_mtime:
+        return IndexEntry(entry.oid)
+    return entry
+
+
+# .rgit/index layout:
+#   header: b"RIDX" | version (4 bytes) | entry count (4 bytes)
+#   entries sorted by path: binary oid (20) | mtime (8) | ctime (8) | size (8)
+#     | inode (8) | mode (4) | path length (2) | path (utf-8)
+#   trailer: sha1 of everything above
+INDEX_MAGIC = b"RIDX"
+INDEX_VERSION = 1
+_INDEX_HEADER = struct.Struct(">4sII")
+_INDEX_ENTRY = struct.Struct(">20sqqQQIH")
+
+
+def _parse_index(content: bytes | mmap.mmap, index_mtime: int) -> Dict[str, IndexEntry]:
+    magic, version, count = _INDEX_HEADER.unpack_from(content, 0)
+    assert magic == INDEX_MAGIC and version == INDEX_VERSION, "bad index header"
+    checksum = content[-20:]
+    assert hashlib.sha1(content[:-20]).digest() == checksum, "index checksum mismatch"
+
+    entries = {}
+    offset = _INDEX_HEADER.size
+    for _ in range(count):
+        oid, mtime, ctime, size, inode, mode, path_len = _INDEX_ENTRY.unpack_from(content, offset)
+        offset += _INDEX_ENTRY.size
+        path = content[offset:offset + path_len].decode()
+        offset += path_len
+        entry = IndexEntry(oid.hex(), mtime, ctime, size, inode, mode)
+        entries[path] = _smudge_racy(entry, index_mtime)
+    return entries
+
 
-    yield index
+def _serialize_index(entries: Dict[str, IndexEntry], now: int) -> bytes:
+    parts = [_INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(entries))]
+    for path in sorted(entries):
+        entry = _smudge_racy(entries[path], now)
+        path_bytes = path.encode()
+        parts.append(_INDEX_ENTRY.pack(
+            bytes.fromhex(entry.oid), entry.mtime, entry.ctime,
+            entry.size, entry.inode, entry.mode, len(path_bytes)
+        ))
+        parts.append(path_bytes)
+    content = b"".join(parts)
+    return content + hashlib.sha1(content).digest()
 
-    with open(index_path, "w") as index_file:
-        json.dump(index, index_file) # rewrite the file
+
+# the index as a dict of path -> IndexEntry. the file is only mapped and parsed
+# the first time someone look inside, and we remember if anyone changed it
+class Index(MutableMapping):
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.dirty = False
+        self._entries: Dict[str, IndexEntry] | None = None
+        self._lock_fd: int | None = None
+        self._loaded_stat: Tuple[int, int, int] | None = None # of the file we read
+
+    def _load(self) -> Dict[str, IndexEntry]:
+        if self._entries is not None:
+            return self._entries
+
+        self._entries = {} # in case we don't have .rgit/index
+        self._loaded_stat = _file_identity(self.path)
+        if not os.path.isfile(self.path) or os.path.getsize(self.path) == 0:
+            return self._entries
+
+        with open(self.path, "rb") as index_file:
+            stat = os.fstat(index_file.fileno())
+            index_mtime = stat.st_mtime_ns
+            self._loaded_stat = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            with mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                if content[:1] == b"{":
+                    # old json index, load it and save it back in the new format
+                    legacy_index = json.loads(content[:])
+                    for path, value in legacy_index.items():
+                        if isinstance(value, str): # oldest index only had the oid
+                            value = [value]
+                        self._entries[path] = _smudge_racy(IndexEntry(*value), index_mtime)
+                    self.dirty = True
+                else:
+                    self._entries = _parse_index(content, index_mtime)
+        return self._entries
+
+    def __getitem__(self, path: str) -> IndexEntry:
+        return self._load()[path]
+
+    def __setitem__(self, path: str, entry: IndexEntry) -> None:
+        entries = self._load()
+        if entries.get(path) != entry:
+            entries[path] = entry
+            self.dirty = True
+
+    def __delitem__(self, path: str) -> None:
+        del self._load()[path]
+        self.dirty = True
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._load())
+
+    def __len__(self) -> int:
+        return len(self._load())
+
+    def clear(self) -> None:
+        self._load()
+        self._entries = {}
+        self.dirty = True
+
+    # create index.lock, a process that change the index hold it from before
+    # it read the index to when the new one is in place, so a second one
+    # can't read the old index and write over the first one's entries
+    def lock(self) -> None:
+        assert self._entries is None, "lock the index before reading it"
+        lock_path = self.path + ".lock"
+        try:
+            self._lock_fd = os.open(lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            raise FileExistsError(f"{lock_path} exists, is another rgit process running?")
+
+    # drop the lock without writing (nothing changed, or an error)
+    def unlock(self) -> None:
+        if self._lock_fd is None:
+            return
+        os.close(self._lock_fd)
+        self._lock_fd = None
+        os.remove(self.path + ".lock")
+
+    # write into index.lock, then rename it over the index, so a reader never
+    # see a half-written index. that also release the lock
+    def write(self) -> None:
+        assert self._lock_fd is not None, "the index is written under lock()"
+        flush_batch() # the blobs of the new entries go to disk first
+        lock_path = self.path + ".lock"
+        fd, self._lock_fd = self._lock_fd, None
+        try:
+            with os.fdopen(fd, "wb") as lock_file:
+                # the lock may be old, touch it so its mtime is "now" in fs clock
+                os.utime(lock_file.fileno())
+                now = os.fstat(lock_file.fileno()).st_mtime_ns
+                lock_file.write(_serialize_index(self._load(), now))
+            move_into_place(lock_path, self.path)
+        except BaseException:
+            os.remove(lock_path)
+            raise
+        self.dirty = False
+
+
+    # a reader only changed cached stat data (or read an old format index),
+    # that can be written back if nobody else is writing or wrote the index
+    # since we read it. otherwise we just skip it, the next read redo it
+    def write_if_unchanged(self) -> None:
+        try:
+            self._lock_fd = os.open(self.path + ".lock", os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            return
+        try:
+            if _file_identity(self.path) == self._loaded_stat:
+                self.write()
+        finally:
+            self.unlock()
+
+
+# what tell us the index file was replaced: (inode, size, mtime), None if there's none
+def _file_identity(path: str) -> Tuple[int, int, int] | None:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+# yield the index (path -> IndexEntry), let the caller deal with it.
+# we only write it back if the caller changed something. use write = True
+# to change entries: then index.lock is held for the whole block
+@contextmanager
+def get_index(write: bool = False) -> Iterator[Index]:
+    index = Index(os.path.join(RGIT_DIR, "index"))
+    if not write:
+        yield index
+        if index.dirty:
+            index.write_if_unchanged()
+        return
+
+    index.lock()
+    try:
+        yield index
+        if index.dirty:
+            index.write()
+    finally:
+        index.unlock() # still held if there was nothing to write, or an error
@@ -0,0 +1,143 @@
+# delta module encode an object as the changes from a similar base object, for
+# packs (see pack.py). the format is the one git uses:
+#   header: base size (varint) | result size (varint)
+#   then ops until the end:
+#     copy:   1xxxxxxx + offset bytes + size bytes, bits 0-3 of the first byte
+#             say which of the 4 offset bytes follow, bits 4-6 which of the 3
+#             size bytes (little-endian, missing bytes are 0)
+#     insert: 0nnnnnnn (n = 1..127) + n bytes to put in the result as they are
+#
+# git finds matches by hashing every 16 byte block of the base and looking up
+# the block at each offset of the target. byte by byte is too slow in python,
+# so our blocks are lines: we index the lines of the base, look up each line of
+# the target and grow a match with bytes.startswith while the next lines of
+# both agree. text files (configs, csv, lockfiles) delta well that way, a
+# binary file with few newlines usually just doesn't get a delta
+from collections import namedtuple
+
+# a line shorter than this can't start a copy (a copy op costs up to 8 bytes),
+# it can still be part of a longer one
+MIN_MATCH = 8
+MAX_INSERT = 0x7f
+MAX_COPY = 0xffffff
+
+# a base ready to delta against: its bytes + line -> first offset of that line
+Index = namedtuple("Index", ["base", "lines"])
+
+
+def create_index(base: bytes) -> Index:
+    lines: dict[bytes, int] = {}
+    offset = 0
+    for line in base.splitlines(keepends=True):
+        if len(line) >= MIN_MATCH:
+            lines.setdefault(line, offset)
+        offset += len(line)
+    return Index(base=base, lines=lines)
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _read_varint(delta: bytes, pos: int) -> tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = delta[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return (value, pos)
+
+
+def _copy_op(offset: int, size: int) -> bytes:
+    op = 0x80
+    args = bytearray()
+    for i in range(4):
+        byte = offset >> (8 * i) & 0xff
+        if byte:
+            op |= 1 << i
+            args.append(byte)
+    for i in range(3):
+        byte = size >> (8 * i) & 0xff
+        if byte:
+            op |= 1 << (4 + i)
+            args.append(byte)
+    return bytes([op]) + args
+
+
+# the delta turning index.base into target, None if it would be more than
+# max_size bytes (then it isn't worth it, and we stop early)
+def create(index: Index, target: bytes, max_size: int) -> bytes | None:
+    base = index.base
+    out = bytearray(_varint(len(base)) + _varint(len(target)))
+    pending = bytearray() # bytes to insert before the next copy
+
+    def flush_pending() -> None:
+        for start in range(0, len(pending), MAX_INSERT):
+            chunk = pending[start:start + MAX_INSERT]
+            out.append(len(chunk))
+            out.extend(chunk)
+        pending.clear()
+
+    lines = target.splitlines(keepends=True)
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        base_offset = index.lines.get(line)
+        i += 1
+        if base_offset is None:
+            pending.extend(line)
+            if len(out) + len(pending) > max_size:
+                return None
+            continue
+
+        # grow the match while the base goes on with the same lines
+        length = len(line)
+        while i < len(lines) and base.startswith(lines[i], base_offset + length):
+            length += len(lines[i])
+            i += 1
+        flush_pending()
+        for start in range(0, length, MAX_COPY):
+            out.extend(_copy_op(base_offset + start, min(MAX_COPY, length - start)))
+        if len(out) > max_size:
+            return None
+
+    flush_pending()
+    if len(out) > max_size:
+        return None
+    return bytes(out)
+
+
+def apply(base: bytes, delta: bytes) -> bytes:
+    base_size, pos = _read_varint(delta, 0)
+    result_size, pos = _read_varint(delta, pos)
+    assert base_size == len(base), f"delta is for a base of {base_size} bytes, not {len(base)}"
+
+    result = bytearray()
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op & 0x80: # copy
+            offset = size = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if op & (1 << (4 + i)):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            result += base[offset:offset + (size or 0x10000)] # git: size 0 means 64k
+        else: # insert
+            assert op, "bad delta op 0"
+            result += delta[pos:pos + op]
+            pos += op
+
+    assert len(result) == result_size, f"delta gave {len(result)} bytes, expected {result_size}"
+    return bytes(result)
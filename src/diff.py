@@ -1,7 +1,8 @@
+import os
 import subprocess
 import sys
 from collections import defaultdict
-from typing import Tuple, Dict, Iterator, IO
+from typing import Tuple, Dict, Iterator
 from src import data
 from tempfile import NamedTemporaryFile as TempFile
 
@@ -21,18 +22,160 @@ def compare_trees(*trees: Tree) -> Iterator[Tuple[str | None, ...]]:
         yield (path, *oids)
 
 
-def diff_trees(tree_to: Tree, tree_from: Tree) -> bytes:
-    msg = b""
-    for path, oid_to, oid_from in compare_trees(tree_to, tree_from):
+# tree entries by name, read through the same parsed-object cache as base
+# return name -> (type, oid) of a tree object, empty for no tree
+def _tree_entries(oid: str | None) -> Dict[str, Tuple[str, str]]:
+    if not oid:
+        return {}
+    return {name: (type_, entry_oid) for type_, entry_oid, name in data.get_tree_entries(oid)}
+
+
+# like compare_trees but takes tree oids and walk them level by level.
+# a subtree with the same oid on every side can't contain changes, so we never
+# read it: the cost follow the size of the change, not the size of the trees.
+# only yield (path, blob_oid0, blob_oid1, ...) for paths that differ
+def compare_tree_oids(*tree_oids: str | None, base_path: str = "") -> Iterator[Tuple[str | None, ...]]:
+    if len(set(tree_oids)) <= 1:
+        return
+
+    levels = [_tree_entries(oid) for oid in tree_oids]
+    names = sorted(set().union(*levels))
+    for name in names:
+        children = [level.get(name) for level in levels]
+        if all(child == children[0] for child in children):
+            continue
+
+        path = base_path + name
+        # a path can be a blob on one side and a tree on another
+        blob_oids = [child[1] if child and child[0] == "blob" else None for child in children]
+        subtree_oids = [child[1] if child and child[0] == "tree" else None for child in children]
+        if len(set(blob_oids)) > 1:
+            yield (path, *blob_oids)
+        yield from compare_tree_oids(*subtree_oids, base_path=path + "/")
+
+
+# group a flat Tree by directory ("" for the root, "a/b/" for a/b):
+# (dir -> name -> blob oid, dir -> names of its subdirs)
+def _group_by_dir(tree: Tree) -> Tuple[Dict[str, Dict[str, str]], Dict[str, set[str]]]:
+    blobs: Dict[str, Dict[str, str]] = defaultdict(dict)
+    subdirs: Dict[str, set[str]] = defaultdict(set)
+    for path, oid in tree.items():
+        dir_name, name = os.path.split(path)
+        blobs[dir_name + "/" if dir_name else ""][name] = oid
+        while dir_name:
+            parent, name = os.path.split(dir_name)
+            parent_dir = parent + "/" if parent else ""
+            if name in subdirs[parent_dir]: break
+            subdirs[parent_dir].add(name)
+            dir_name = parent
+    return (blobs, subdirs)
+
+
+# the oid every directory would get as a tree object, hashed in memory,
+# nothing is written. a directory where one name is both a file and a
+# directory (a file replaced by a dir before the file was unstaged) can't be
+# a tree object, it gets no oid
+def _get_tree_oids(blobs: Dict[str, Dict[str, str]], subdirs: Dict[str, set[str]]) -> Dict[str, str]:
+    tree_oids: Dict[str, str] = {}
+    # deepest first, so the subtree oids are there when we need them
+    for dir_path in sorted(set(blobs) | set(subdirs), key=lambda dir_path: -dir_path.count("/")):
+        dir_blobs = blobs.get(dir_path, {})
+        entries = [("blob", oid, name) for name, oid in dir_blobs.items()]
+        for name in subdirs.get(dir_path, set()):
+            subtree_oid = tree_oids.get(dir_path + name + "/")
+            if subtree_oid is None or name in dir_blobs:
+                break
+            entries.append(("tree", subtree_oid, name))
+        else:
+            tree_oids[dir_path] = data.hash_object(data.format_tree(entries), type_="tree", write=False)
+    return tree_oids
+
+
+# like compare_tree_oids, with one side a flat Tree (the index) we don't want
+# to write tree objects for: its directories are hashed in memory, and one
+# with the same oid as the tree object's is skipped.
+# yield (path, oid in tree, oid in tree object) for paths that differ
+def compare_tree_with_oid(tree: Tree, tree_oid: str | None) -> Iterator[Tuple[str, str | None, str | None]]:
+    blobs, subdirs = _group_by_dir(tree)
+    tree_oids = _get_tree_oids(blobs, subdirs)
+
+    def walk(dir_path: str, subtree_oid: str | None) -> Iterator[Tuple[str, str | None, str | None]]:
+        if subtree_oid is not None and tree_oids.get(dir_path) == subtree_oid:
+            return
+        entries = _tree_entries(subtree_oid)
+        dir_blobs = blobs.get(dir_path, {})
+        dir_subdirs = subdirs.get(dir_path, set())
+        for name in sorted(set(entries) | set(dir_blobs) | dir_subdirs):
+            type_, oid = entries.get(name, (None, None))
+            blob_oid = oid if type_ == "blob" else None
+            if dir_blobs.get(name) != blob_oid:
+                yield (dir_path + name, dir_blobs.get(name), blob_oid)
+            if type_ == "tree" or name in dir_subdirs:
+                yield from walk(dir_path + name + "/", oid if type_ == "tree" else None)
+
+    return walk("", tree_oid)
+
+
+# trees can be flattened Tree dicts or tree oids. two oids get the
+# subtree-pruning walk, a Tree and an oid the same walk with the Tree's
+# directories hashed in memory
+def _compare_two(tree_to: Tree | str, tree_from: Tree | str) -> Iterator[Tuple[str | None, ...]]:
+    if isinstance(tree_to, str) and isinstance(tree_from, str):
+        return compare_tree_oids(tree_to, tree_from)
+    if isinstance(tree_to, dict) and isinstance(tree_from, str):
+        return compare_tree_with_oid(tree_to, tree_from)
+    if isinstance(tree_to, str) and isinstance(tree_from, dict):
+        return ((path, oid_to, oid_from) for path, oid_from, oid_to in compare_tree_with_oid(tree_from, tree_to))
+    assert isinstance(tree_to, dict) and isinstance(tree_from, dict)
+    return compare_trees(tree_to, tree_from)
+
+
+CONTEXT_LINES = 3
+FUNCTION_LINE_WIDTH = 40 # same as diff --show-c-function
+BINARY_CHECK_SIZE = 8000 # a NUL byte in here means binary file
+
+
+# use to_worktree=True when tree_to is the working tree, its blobs aren't in
+# the object store so we read them from the files.
+# yield the diff file by file (hunk by hunk), so the caller can stream it out
+def diff_trees(
+    tree_to: Tree | str,
+    tree_from: Tree | str,
+    to_worktree: bool = False,
+    external: bool = False
+) -> Iterator[bytes]:
+    for path, oid_to, oid_from in _compare_two(tree_to, tree_from):
         if oid_to != oid_from:
-            msg += diff_blobs(oid_to, oid_from, path)
-    return msg
+            yield from diff_blobs(oid_to, oid_from, path, to_worktree, external)
 
 
-def diff_blobs(blob_to_oid: str | None, blob_from_oid: str | None, path: str | None ="blob") -> bytes:
-    blob_to_content = data.get_object_content(blob_to_oid) if blob_to_oid else b""
-    blob_from_content = data.get_object_content(blob_from_oid) if blob_from_oid else b""
+def _read_blob(oid: str | None, path: str | None, from_worktree: bool = False) -> bytes:
+    if not oid:
+        return b""
+    if from_worktree and path is not None:
+        with open(path, "rb") as file:
+            return file.read()
+    return data.get_object_content(oid)
 
+
+# yield unified diff (like diff --unified --show-c-function) of 2 blobs.
+# external=True fork /usr/bin/diff instead of using our own engine
+def diff_blobs(
+    blob_to_oid: str | None,
+    blob_from_oid: str | None,
+    path: str | None ="blob",
+    to_worktree: bool = False,
+    external: bool = False
+) -> Iterator[bytes]:
+    blob_to_content = _read_blob(blob_to_oid, path, from_worktree=to_worktree)
+    blob_from_content = _read_blob(blob_from_oid, path)
+    if external:
+        yield _diff_external(blob_to_content, blob_from_content, path)
+    else:
+        yield from unified_diff(blob_from_content, blob_to_content, f"a/{path}", f"b/{path}")
+
+
+def _diff_external(blob_to_content: bytes, blob_from_content: bytes, path: str | None) -> bytes:
     with TempFile() as blob_to, TempFile() as blob_from:
         blob_to.write(blob_to_content)
         blob_to.flush()
@@ -50,56 +193,324 @@ def diff_blobs(blob_to_oid: str | None, blob_from_oid: str | None, path: str | N
         return diff_msg
 
 
-def iter_changed_files(tree_to: Tree, tree_from: Tree) -> Iterator[Tuple[str, str]]:
-    for path, oid_to, oid_from in compare_trees(tree_to, tree_from):
+# split on b"\n" only and keep it, so the last line without newline is different
+# from the same line with newline (that's how diff know to say "No newline")
+def split_lines(content: bytes) -> list[bytes]:
+    lines = content.split(b"\n")
+    last = lines.pop()
+    lines = [line + b"\n" for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+# Myers' O(ND) diff in linear space: find the middle snake of the shortest
+# edit script, then solve both halves around it. a and b are lists of ints
+# (line ids), and we append every matched (i, j) in order to matches
+def _myers_matches(
+    a: list[int], a_lo: int, a_hi: int,
+    b: list[int], b_lo: int, b_hi: int,
+    matches: list[Tuple[int, int]]
+) -> None:
+    # common prefix and suffix are cheap, take them out first
+    while a_lo < a_hi and b_lo < b_hi and a[a_lo] == b[b_lo]:
+        matches.append((a_lo, b_lo))
+        a_lo += 1
+        b_lo += 1
+    suffix_len = 0
+    while a_lo < a_hi and b_lo < b_hi and a[a_hi - 1] == b[b_hi - 1]:
+        a_hi -= 1
+        b_hi -= 1
+        suffix_len += 1
+
+    if a_lo < a_hi and b_lo < b_hi:
+        x_start, y_start, x_end, y_end = _middle_snake(a, a_lo, a_hi, b, b_lo, b_hi)
+        _myers_matches(a, a_lo, x_start, b, b_lo, y_start, matches)
+        matches.extend(zip(range(x_start, x_end), range(y_start, y_end)))
+        _myers_matches(a, x_end, a_hi, b, y_end, b_hi, matches)
+
+    matches.extend(zip(range(a_hi, a_hi + suffix_len), range(b_hi, b_hi + suffix_len)))
+
+
+# walk forward from the start and backward from the end at the same time,
+# diagonal k means x - y = k. return the snake (x_start, y_start, x_end, y_end)
+# where both walks meet, it sits in the middle of an optimal edit script
+def _middle_snake(
+    a: list[int], a_lo: int, a_hi: int,
+    b: list[int], b_lo: int, b_hi: int
+) -> Tuple[int, int, int, int]:
+    n, m = a_hi - a_lo, b_hi - b_lo
+    delta = n - m
+    odd = delta % 2 == 1
+    max_d = (n + m + 1) // 2
+    # furthest x reached on each diagonal, dicts since d is usually way
+    # smaller than n + m and we don't want to allocate for all diagonals
+    forward = {1: 0}
+    backward = {1: 0} # same, counted from the ends
+
+    for d in range(max_d + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and forward[k - 1] < forward[k + 1]):
+                x = forward[k + 1] # step down (insert)
+            else:
+                x = forward[k - 1] + 1 # step right (delete)
+            y = x - k
+            x_start, y_start = x, y
+            while x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+                x += 1
+                y += 1
+            forward[k] = x
+            # the backward walk on diagonal delta - k has done d - 1 steps
+            if odd and -(d - 1) <= delta - k <= d - 1:
+                if x + backward[delta - k] >= n:
+                    return (a_lo + x_start, b_lo + y_start, a_lo + x, b_lo + y)
+
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and backward[k - 1] < backward[k + 1]):
+                x = backward[k + 1]
+            else:
+                x = backward[k - 1] + 1
+            y = x - k
+            x_start, y_start = x, y
+            while x < n and y < m and a[a_hi - 1 - x] == b[b_hi - 1 - y]:
+                x += 1
+                y += 1
+            backward[k] = x
+            # the forward walk on diagonal delta - k has done d steps
+            if not odd and -d <= delta - k <= d:
+                if x + forward[delta - k] >= n:
+                    return (a_hi - x, b_hi - y, a_hi - x_start, b_hi - y_start)
+
+    raise AssertionError("middle snake not found")
+
+
+# return matching blocks (a_start, b_start, length) of 2 lists of lines,
+# ending with a (len(a), len(b), 0) sentinel like difflib does
+def matching_blocks(a_lines: list[bytes], b_lines: list[bytes]) -> list[Tuple[int, int, int]]:
+    # compare small ints instead of whole lines
+    line_ids: Dict[bytes, int] = {}
+    a_ids = [line_ids.setdefault(line, len(line_ids)) for line in a_lines]
+    b_ids = [line_ids.setdefault(line, len(line_ids)) for line in b_lines]
+
+    # a line that only exist on one side can never match, so (like GNU diff)
+    # we drop them before Myers, they would only make the edit script longer
+    b_set, a_set = set(b_ids), set(a_ids)
+    a_kept = [i for i, line_id in enumerate(a_ids) if line_id in b_set]
+    b_kept = [j for j, line_id in enumerate(b_ids) if line_id in a_set]
+    a = [a_ids[i] for i in a_kept]
+    b = [b_ids[j] for j in b_kept]
+
+    matches: list[Tuple[int, int]] = []
+    _myers_matches(a, 0, len(a), b, 0, len(b), matches)
+
+    blocks: list[Tuple[int, int, int]] = []
+    for i, j in ((a_kept[i], b_kept[j]) for i, j in matches):
+        if blocks and blocks[-1][0] + blocks[-1][2] == i and blocks[-1][1] + blocks[-1][2] == j:
+            blocks[-1] = (blocks[-1][0], blocks[-1][1], blocks[-1][2] + 1)
+        else:
+            blocks.append((i, j, 1))
+    blocks.append((len(a_lines), len(b_lines), 0))
+    return blocks
+
+
+# return the changed regions (a_start, a_end, b_start, b_end) between a and b
+def _changes(a_lines: list[bytes], b_lines: list[bytes]) -> list[Tuple[int, int, int, int]]:
+    changes = []
+    i = j = 0
+    for a_start, b_start, length in matching_blocks(a_lines, b_lines):
+        if i < a_start or j < b_start:
+            changes.append((i, a_start, j, b_start))
+        i, j = a_start + length, b_start + length
+    return changes
+
+
+def _hunk_range(start: int, length: int) -> str:
+    if length == 1:
+        return str(start + 1)
+    if length == 0: # empty range point at the line before it
+        return f"{start},0"
+    return f"{start + 1},{length}"
+
+
+def _is_function_line(line: bytes) -> bool:
+    return line[:1].isalpha() or line[:1] in (b"_", b"$")
+
+
+def _format_function_line(line: bytes) -> bytes:
+    return b" " + line.strip()[:FUNCTION_LINE_WIDTH].rstrip()
+
+
+# yield the unified diff of 2 contents, one hunk at a time
+def unified_diff(
+    from_content: bytes,
+    to_content: bytes,
+    from_label: str,
+    to_label: str,
+    context: int = CONTEXT_LINES
+) -> Iterator[bytes]:
+    if from_content == to_content:
+        return
+    if b"\0" in from_content[:BINARY_CHECK_SIZE] or b"\0" in to_content[:BINARY_CHECK_SIZE]:
+        yield f"Binary files {from_label} and {to_label} differ\n".encode()
+        return
+
+    a_lines, b_lines = split_lines(from_content), split_lines(to_content)
+    changes = _changes(a_lines, b_lines)
+
+    yield f"--- {from_label}\n+++ {to_label}\n".encode()
+
+    function_line = b""
+    searched_to = 0 # we already looked for function line in a_lines[:searched_to]
+    i = 0
+    while i < len(changes):
+        # merge the next changes into this hunk while the gap between them
+        # is small enough that their context would touch
+        last = i
+        while last + 1 < len(changes) and changes[last + 1][0] - changes[last][1] <= 2 * context:
+            last += 1
+
+        a_start = max(changes[i][0] - context, 0)
+        b_start = max(changes[i][2] - context, 0)
+        a_end = min(changes[last][1] + context, len(a_lines))
+        b_end = min(changes[last][3] + context, len(b_lines))
+
+        for line_no in range(a_start - 1, searched_to - 1, -1):
+            if _is_function_line(a_lines[line_no]):
+                function_line = _format_function_line(a_lines[line_no])
+                break
+        searched_to = max(searched_to, a_start)
+
+        hunk = [
+            f"@@ -{_hunk_range(a_start, a_end - a_start)} "
+            f"+{_hunk_range(b_start, b_end - b_start)} @@".encode() + function_line + b"\n"
+        ]
+        a_pos = a_start
+        for change_a_start, change_a_end, change_b_start, change_b_end in changes[i:last + 1]:
+            hunk.extend(b" " + line for line in a_lines[a_pos:change_a_start])
+            hunk.extend(b"-" + line for line in a_lines[change_a_start:change_a_end])
+            hunk.extend(b"+" + line for line in b_lines[change_b_start:change_b_end])
+            a_pos = change_a_end
+        hunk.extend(b" " + line for line in a_lines[a_pos:a_end])
+
+        yield b"".join(
+            line if line.endswith(b"\n") else line + b"\n\\ No newline at end of file\n"
+            for line in hunk
+        )
+        i = last + 1
+
+
+def iter_changed_files(tree_to: Tree | str, tree_from: Tree | str) -> Iterator[Tuple[str, str]]:
+    for path, oid_to, oid_from in _compare_two(tree_to, tree_from):
         if oid_to == oid_from or path is None: continue
         elif oid_from is None: yield (path, "created")
         elif oid_to is None: yield (path, "deleted")
         else: yield (path, "modified")
 
 
-def _temp_file(oid: str | None) -> IO[bytes]:
-    file = TempFile()
-    content = data.get_object_content(oid) if oid else b""
-    file.write(content)
-    file.flush()
-    return file
-
-
 # check if the content of the merge file show conflict by diff3
 def check_conflict(content :bytes) -> bool:
     return b"<<<<<<<" in content and b">>>>>>>" in content
 
 
+def _conflict_section(marker: str, lines: list[bytes]) -> list[bytes]:
+    section = [f"{marker}\n".encode()] + lines
+    if lines and not lines[-1].endswith(b"\n"): # keep the next marker on its own line
+        section[-1] += b"\n"
+    return section
+
+
+# line-level 3-way merge (like diff3 -m). take the changes base -> head and
+# base -> other, group the ones that overlap or touch in base, and
+# - changes from only one side are applied
+# - both sides made the same change: applied once
+# - otherwise we write the conflict with the same markers diff3 use
+# return (merged content, has conflict)
+def merge_contents(head: bytes, other: bytes, base: bytes) -> Tuple[bytes, bool]:
+    base_lines = split_lines(base)
+    sides = (split_lines(head), split_lines(other))
+    # (base_start, base_end, side_start, side_end, side)
+    changes = sorted(
+        (*change, side)
+        for side, side_lines in enumerate(sides)
+        for change in _changes(base_lines, side_lines)
+    )
+
+    merged: list[bytes] = []
+    has_conflict = False
+    base_pos = 0
+    i = 0
+    while i < len(changes):
+        group = [changes[i]]
+        lo, hi = changes[i][0], changes[i][1]
+        while i + len(group) < len(changes) and changes[i + len(group)][0] <= hi:
+            hi = max(hi, changes[i + len(group)][1])
+            group.append(changes[i + len(group)])
+        i += len(group)
+
+        merged.extend(base_lines[base_pos:lo])
+        base_pos = hi
+
+        # what each side has in place of base_lines[lo:hi]
+        regions = []
+        for side, side_lines in enumerate(sides):
+            side_changes = [change for change in group if change[4] == side]
+            if not side_changes:
+                regions.append(base_lines[lo:hi])
+                continue
+            first, last = side_changes[0], side_changes[-1]
+            side_lo = first[2] - (first[0] - lo)
+            side_hi = last[3] + (hi - last[1])
+            regions.append(side_lines[side_lo:side_hi])
+
+        head_region, other_region = regions
+        if head_region == other_region or all(change[4] == 0 for change in group):
+            merged.extend(head_region)
+        elif all(change[4] == 1 for change in group):
+            merged.extend(other_region)
+        else:
+            has_conflict = True
+            merged.extend(_conflict_section("<<<<<<< HEAD", head_region))
+            merged.extend(_conflict_section("||||||| BASE", base_lines[lo:hi]))
+            merged.extend(_conflict_section("=======", other_region))
+            merged.append(b">>>>>>> MERGE_HEAD\n")
+
+    merged.extend(base_lines[base_pos:])
+    return (b"".join(merged), has_conflict)
+
+
 def merge_blobs(
     head_oid: str | None,
     other_oid: str | None,
     base_oid: str | None
 ) -> Tuple[str, bool]:
-    with _temp_file(head_oid) as head_file, \
-         _temp_file(other_oid) as other_file, \
-         _temp_file(base_oid) as base_file:
-        with subprocess.Popen(
-            ["/usr/bin/diff3", "-m",
-                "-L", "HEAD", head_file.name,
-                "-L", "BASE", base_file.name,
-                "-L", "MERGE_HEAD", other_file.name],
-            stdout=subprocess.PIPE
-        ) as process:
-            merged_content, _ = process.communicate()
+    head = data.get_object_content(head_oid) if head_oid else b""
+    other = data.get_object_content(other_oid) if other_oid else b""
+    base = data.get_object_content(base_oid) if base_oid else b""
 
-        merged_oid = data.hash_object(merged_content, type_="blob")
-        conflict = check_conflict(merged_content)
-        return (merged_oid, conflict)
+    merged_content, conflict = merge_contents(head, other, base)
+    merged_oid = data.hash_object(merged_content, type_="blob")
+    return (merged_oid, conflict)
 
 
+# most paths are settled by their oids alone, we only read and merge the blobs
+# that both sides changed differently. None means the path doesn't exist there
 def merge_trees(tree_to: Tree, tree_from: Tree, tree_base: Tree) -> Tuple[Tree, list[str]]:
     merged_tree = {}
     conflict_files = []
     for path, blob_to, blob_from, blob_base in compare_trees(tree_to, tree_from, tree_base):
-        merged_blob_oid, has_conflict = merge_blobs(blob_to, blob_from, blob_base)
         assert path
-        merged_tree[path] = merged_blob_oid
+        has_conflict = False
+        if blob_to == blob_from: # same on both side (or both deleted it)
+            merged_blob_oid = blob_to
+        elif blob_to == blob_base: # only other side changed it
+            merged_blob_oid = blob_from
+        elif blob_from == blob_base: # only our side changed it
+            merged_blob_oid = blob_to
+        else:
+            merged_blob_oid, has_conflict = merge_blobs(blob_to, blob_from, blob_base)
+
+        if merged_blob_oid is not None:
+            merged_tree[path] = merged_blob_oid
         if has_conflict:
             conflict_files.append(path)
     return (merged_tree, conflict_files)
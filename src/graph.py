@@ -0,0 +1,311 @@
+# graph module keep the commit-graph: a sorted table of commit -> (tree, parents,
+# generation) so history walks don't have to open, read and parse every commit.
+#
+# the graph is a chain of layer files (objects/info/commit-graphs/graph-<sha1>.graph)
+# listed base layer first in objects/info/commit-graph-chain. new commits are added
+# as a small layer on top, and the top layers are merged when the top one get as
+# big as half the one below, so there are only O(log n) layers.
+#
+# layer layout:
+#   header: b"RCGR" | version (4) | commit count (4) | commits in lower layers (4)
+#   fanout: 256 * 4 bytes, fanout[b] = number of oids whose first byte <= b
+#   oids: count * 20 bytes, sorted
+#   commit data: count * (tree oid (20) | parent 1 (4) | parent 2 (4) | generation (4))
+#     a parent is a position in the whole chain (lower layers come first).
+#     parent 2 with EXTRA_EDGES bit set is an index into the extra edges instead
+#   extra edges: 4 bytes positions for commits with > 2 parents, the last one of
+#     each list has LAST_EDGE bit set
+#   trailer: sha1 of everything above (this is also the layer name)
+import os
+import mmap
+import struct
+import hashlib
+from collections import namedtuple
+from typing import Dict, Iterator, Tuple
+from src import data
+
+MAGIC = b"RCGR"
+VERSION = 1
+NO_PARENT = 0x70000000
+EXTRA_EDGES = 0x80000000
+LAST_EDGE = 0x80000000
+OID_SIZE = 20
+
+_HEADER = struct.Struct(">4sIII")
+_FANOUT = struct.Struct(">256I")
+_RECORD = struct.Struct(">20sIII")
+_POSITION = struct.Struct(">I")
+_OIDS_START = _HEADER.size + _FANOUT.size
+
+Layer = namedtuple("Layer", ["name", "data", "count", "base_count"])
+# what the graph know about one commit
+CommitInfo = namedtuple("CommitInfo", ["tree", "parents", "generation"])
+# what we need to put one commit in the graph: oid -> (tree, parents)
+type Commits = Dict[str, Tuple[str, list[str]]]
+
+# layers we already mapped for each rgit dir: RGIT_DIR -> layers
+_loaded_layers: Dict[str, list[Layer]] = {}
+
+
+def _info_dir() -> str:
+    return os.path.join(data.RGIT_DIR, "objects", "info")
+
+
+def _chain_path() -> str:
+    return os.path.join(_info_dir(), "commit-graph-chain")
+
+
+def _layer_path(name: str) -> str:
+    return os.path.join(_info_dir(), "commit-graphs", f"{name}.graph")
+
+
+def exists() -> bool:
+    return os.path.isfile(_chain_path())
+
+
+def _get_layers() -> list[Layer]:
+    layers = _loaded_layers.get(data.RGIT_DIR)
+    if layers is not None:
+        return layers
+
+    layers = []
+    if exists():
+        with open(_chain_path(), "r") as chain_file:
+            names = chain_file.read().split()
+        for name in names:
+            with open(_layer_path(name), "rb") as layer_file:
+                layer_data = mmap.mmap(layer_file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, count, base_count = _HEADER.unpack_from(layer_data, 0)
+            assert magic == MAGIC and version == VERSION, f"bad commit-graph layer {name}"
+            assert base_count == sum(layer.count for layer in layers), f"broken commit-graph chain at {name}"
+            layers.append(Layer(name=name, data=layer_data, count=count, base_count=base_count))
+    _loaded_layers[data.RGIT_DIR] = layers
+    return layers
+
+
+def _local_oid(layer: Layer, i: int) -> bytes:
+    start = _OIDS_START + i * OID_SIZE
+    return layer.data[start:start + OID_SIZE]
+
+
+# binary search a layer (narrowed by fanout), return local position or -1
+def _find_in_layer(layer: Layer, target: bytes) -> int:
+    first = target[0]
+    lo = _POSITION.unpack_from(layer.data, _HEADER.size + (first - 1) * 4)[0] if first else 0
+    hi = _POSITION.unpack_from(layer.data, _HEADER.size + first * 4)[0]
+    while lo < hi:
+        mid = (lo + hi) // 2
+        mid_oid = _local_oid(layer, mid)
+        if mid_oid < target:
+            lo = mid + 1
+        elif mid_oid > target:
+            hi = mid
+        else:
+            return mid
+    return -1
+
+
+# return the position of oid in the whole chain, or -1
+def _find(layers: list[Layer], oid: str) -> int:
+    try:
+        target = bytes.fromhex(oid)
+    except ValueError:
+        return -1
+    if len(target) != OID_SIZE:
+        return -1
+    for layer in layers:
+        i = _find_in_layer(layer, target)
+        if i >= 0:
+            return layer.base_count + i
+    return -1
+
+
+def _layer_at(layers: list[Layer], position: int) -> Tuple[Layer, int]:
+    for layer in layers:
+        if position < layer.base_count + layer.count:
+            return (layer, position - layer.base_count)
+    raise IndexError(f"commit-graph position {position} out of range")
+
+
+def _record(layer: Layer, i: int) -> Tuple[bytes, int, int, int]:
+    return _RECORD.unpack_from(layer.data, _OIDS_START + layer.count * OID_SIZE + i * _RECORD.size)
+
+
+def _oid_at(layers: list[Layer], position: int) -> str:
+    layer, i = _layer_at(layers, position)
+    return _local_oid(layer, i).hex()
+
+
+def _parents_at(layers: list[Layer], layer: Layer, parent_1: int, parent_2: int) -> list[str]:
+    if parent_1 == NO_PARENT:
+        return []
+    parents = [_oid_at(layers, parent_1)]
+    if parent_2 == NO_PARENT:
+        return parents
+    if not parent_2 & EXTRA_EDGES:
+        parents.append(_oid_at(layers, parent_2))
+        return parents
+
+    edges_start = _OIDS_START + layer.count * (OID_SIZE + _RECORD.size)
+    edge_offset = edges_start + (parent_2 & ~EXTRA_EDGES) * _POSITION.size
+    while True:
+        edge = _POSITION.unpack_from(layer.data, edge_offset)[0]
+        parents.append(_oid_at(layers, edge & ~LAST_EDGE))
+        if edge & LAST_EDGE:
+            return parents
+        edge_offset += _POSITION.size
+
+
+# return tree, parents and generation of a commit, None if it's not in the graph
+def lookup(oid: str) -> CommitInfo | None:
+    layers = _get_layers()
+    position = _find(layers, oid)
+    if position < 0:
+        return None
+    layer, i = _layer_at(layers, position)
+    tree, parent_1, parent_2, generation = _record(layer, i)
+    return CommitInfo(
+        tree=tree.hex(),
+        parents=_parents_at(layers, layer, parent_1, parent_2),
+        generation=generation
+    )
+
+
+# generation = 1 + max(parent generations), a root commit has 1.
+# so a commit can only be an ancestor of commits with a bigger generation
+def get_generation(oid: str) -> int | None:
+    layers = _get_layers()
+    position = _find(layers, oid)
+    if position < 0:
+        return None
+    layer, i = _layer_at(layers, position)
+    return _record(layer, i)[3]
+
+
+def contains(oid: str) -> bool:
+    return _find(_get_layers(), oid) >= 0
+
+
+def _iter_layer_commits(layers: list[Layer], layer: Layer) -> Iterator[Tuple[str, Tuple[str, list[str]]]]:
+    for i in range(layer.count):
+        tree, parent_1, parent_2, _ = _record(layer, i)
+        yield (_local_oid(layer, i).hex(), (tree.hex(), _parents_at(layers, layer, parent_1, parent_2)))
+
+
+# serialize commits into one layer on top of lower layers, return the layer name.
+# every parent has to be in commits or in a lower layer
+def _write_layer(lower: list[Layer], commits: Commits) -> str:
+    base_count = sum(layer.count for layer in lower)
+    oids = sorted(commits)
+    positions = {oid: base_count + i for i, oid in enumerate(oids)}
+
+    def position_of(oid: str) -> int:
+        if oid in positions:
+            return positions[oid]
+        position = _find(lower, oid)
+        assert position >= 0, f"commit {oid} is not in the commit-graph"
+        return position
+
+    # generation of new commits, parents first (iterative, history can be deep)
+    generations: Dict[str, int] = {}
+    for oid in oids:
+        stack = [oid]
+        while stack:
+            current = stack[-1]
+            if current in generations:
+                stack.pop()
+                continue
+            pending = [parent for parent in commits[current][1]
+                if parent in commits and parent not in generations]
+            if pending:
+                stack.extend(pending)
+                continue
+            parent_generations = [
+                generations[parent] if parent in commits else _generation_at(lower, position_of(parent))
+                for parent in commits[current][1]
+            ]
+            generations[current] = 1 + max(parent_generations, default=0)
+            stack.pop()
+
+    fanout = [0] * 256
+    for oid in oids:
+        fanout[int(oid[:2], 16)] += 1
+    for byte in range(1, 256):
+        fanout[byte] += fanout[byte - 1]
+
+    records = []
+    extra_edges: list[int] = []
+    for oid in oids:
+        tree, parents = commits[oid]
+        parent_positions = [position_of(parent) for parent in parents]
+        parent_1 = parent_positions[0] if parent_positions else NO_PARENT
+        if len(parent_positions) <= 1:
+            parent_2 = NO_PARENT
+        elif len(parent_positions) == 2:
+            parent_2 = parent_positions[1]
+        else:
+            parent_2 = EXTRA_EDGES | len(extra_edges)
+            extra_edges.extend(parent_positions[1:-1])
+            extra_edges.append(parent_positions[-1] | LAST_EDGE)
+        records.append(_RECORD.pack(bytes.fromhex(tree), parent_1, parent_2, generations[oid]))
+
+    content = b"".join([
+        _HEADER.pack(MAGIC, VERSION, len(oids), base_count),
+        _FANOUT.pack(*fanout),
+        b"".join(bytes.fromhex(oid) for oid in oids),
+        b"".join(records),
+        b"".join(_POSITION.pack(edge) for edge in extra_edges),
+    ])
+    checksum = hashlib.sha1(content).digest()
+    name = f"graph-{checksum.hex()}"
+
+    layer_path = _layer_path(name)
+    os.makedirs(os.path.dirname(layer_path), exist_ok=True)
+    with open(layer_path + ".tmp", "wb") as layer_file:
+        layer_file.write(content + checksum)
+    data.move_into_place(layer_path + ".tmp", layer_path)
+    return name
+
+
+def _generation_at(layers: list[Layer], position: int) -> int:
+    layer, i = _layer_at(layers, position)
+    return _record(layer, i)[3]
+
+
+# point the chain file to names, then drop layers nobody use anymore
+def _write_chain(names: list[str]) -> None:
+    old_names = [layer.name for layer in _get_layers()]
+    os.makedirs(_info_dir(), exist_ok=True)
+    with open(_chain_path() + ".tmp", "w") as chain_file:
+        chain_file.write("".join(f"{name}\n" for name in names))
+    data.move_into_place(_chain_path() + ".tmp", _chain_path()) # after the layers it lists
+    _loaded_layers.pop(data.RGIT_DIR, None)
+
+    for name in set(old_names) - set(names):
+        os.remove(_layer_path(name))
+
+
+# replace the whole graph with a single layer of commits, return the commit count
+def write(commits: Commits) -> int:
+    name = _write_layer([], commits)
+    _write_chain([name])
+    return len(commits)
+
+
+# add commits (their parents have to be in the graph or in commits) as a new
+# top layer, then merge the top layers while the top one is big compared to
+# the one below it
+def append(commits: Commits) -> None:
+    commits = {oid: value for oid, value in commits.items() if not contains(oid)}
+    if not commits:
+        return
+
+    layers = _get_layers()
+    names = [layer.name for layer in layers]
+    while layers and layers[-1].count <= 2 * len(commits):
+        top = layers[-1]
+        commits.update(_iter_layer_commits(layers, top))
+        layers = layers[:-1]
+        names.pop()
+    names.append(_write_layer(layers, commits))
+    _write_chain(names)
@@ -0,0 +1,171 @@
+# ignore module decide which files of the working tree rgit doesn't look at.
+# .rgit and .git are always ignored, the rest come from .rgitignore files, one
+# per directory if you want, with gitignore patterns:
+#   # comment, blank lines are skipped, \# and \! for a literal # or !
+#   !pattern   un-ignore what an earlier pattern ignored
+#   pattern/   only match directories
+#   a/b, /a    a slash at the start or middle anchor the pattern to the
+#              directory of its .rgitignore, else it match a name at any depth
+#   * ? [a-z]  don't match "/". ** match any number of dirs (a/**/b, **/a, a/**)
+# the last pattern that match wins, and a .rgitignore in a deeper directory
+# wins over the ones above. like git, a file in an ignored directory can't be
+# un-ignored: we never even list that directory.
+#
+# each .rgitignore is compiled to one regex: the patterns in reverse order,
+# each in its own group, so the first alternative that match is the last
+# pattern, and match.lastindex tell us if it was a negation
+import os
+import re
+from collections import namedtuple
+from typing import Dict, Iterator, List
+
+IGNORE_FILE = ".rgitignore"
+ALWAYS_IGNORED = (".rgit", ".git")
+
+# the patterns of one .rgitignore. file_regex leave out the dir-only patterns,
+# negations[i] is True if group i + 1 was a !pattern
+Rules = namedtuple("Rules", ["file_regex", "dir_regex", "file_negations", "dir_negations"])
+
+
+# gitignore glob -> regex, for a pattern already stripped of "!", and of the
+# leading and trailing "/"
+def _translate(pattern: str) -> str:
+    out = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "*" and pattern.startswith("**", i) \
+                and (i == 0 or pattern[i - 1] == "/") \
+                and (i + 2 == len(pattern) or pattern[i + 2] == "/"):
+            if i + 2 == len(pattern): # a/** : everything inside
+                out.append(".*")
+                i += 2
+            else: # **/ : zero or more dirs
+                out.append("(?:.*/)?")
+                i += 3
+            continue
+
+        if char == "*":
+            out.append("[^/]*")
+        elif char == "?":
+            out.append("[^/]")
+        elif char == "[":
+            end = pattern.find("]", i + 2) # "[]a]": a ] right after [ is literal
+            if end == -1:
+                out.append(re.escape(char))
+            else:
+                body = pattern[i + 1:end].replace("[", "\\[")
+                if body[0] in "!^":
+                    body = "^" + body[1:]
+                out.append(f"[{body}]")
+                i = end
+        elif char == "\\" and i + 1 < len(pattern):
+            i += 1
+            out.append(re.escape(pattern[i]))
+        else:
+            out.append(re.escape(char))
+        i += 1
+    return "".join(out)
+
+
+def _compile_alternatives(patterns: List[tuple[str, bool]]) -> re.Pattern | None:
+    if not patterns:
+        return None
+    return re.compile("|".join(f"({regex})" for regex, _ in reversed(patterns)))
+
+
+# compile the lines of a .rgitignore, None if there isn't any pattern in it
+def compile_rules(lines: Iterator[str]) -> Rules | None:
+    file_patterns = []
+    dir_patterns = []
+    for line in lines:
+        line = line.rstrip("\n")
+        while line.endswith(" ") and not line.endswith("\\ "):
+            line = line[:-1]
+        if not line or line.startswith("#"):
+            continue
+
+        negate = line.startswith("!")
+        if negate:
+            line = line[1:]
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+        if not line:
+            continue
+        anchored = "/" in line
+        regex = _translate(line.lstrip("/"))
+        if not anchored:
+            regex = "(?:.*/)?" + regex
+
+        dir_patterns.append((regex, negate))
+        if not dir_only:
+            file_patterns.append((regex, negate))
+
+    if not dir_patterns:
+        return None
+    return Rules(
+        file_regex=_compile_alternatives(file_patterns),
+        dir_regex=_compile_alternatives(dir_patterns),
+        file_negations=[negate for _, negate in reversed(file_patterns)],
+        dir_negations=[negate for _, negate in reversed(dir_patterns)],
+    )
+
+
+# match paths (relative to root, with "/") against the .rgitignore files of
+# root and the directories in between. each file is read and compiled once.
+# is_ignored only look at the path itself, not its parent dirs: walking
+# top-down and skipping ignored dirs (like iter_files) cover those
+class Matcher:
+    def __init__(self, root: str = ".") -> None:
+        self.root = root
+        self._rules: Dict[str, Rules | None] = {} # dir ("" for root) -> rules
+
+    def _get_rules(self, dir_path: str) -> Rules | None:
+        if dir_path not in self._rules:
+            try:
+                with open(os.path.join(self.root, dir_path, IGNORE_FILE), errors="replace") as file:
+                    self._rules[dir_path] = compile_rules(file)
+            except OSError: # no .rgitignore there (or it isn't a file)
+                self._rules[dir_path] = None
+        return self._rules[dir_path]
+
+    def is_ignored(self, path: str, is_dir: bool = False) -> bool:
+        if os.path.basename(path) in ALWAYS_IGNORED:
+            return True
+
+        dir_path = os.path.dirname(path)
+        while True:
+            rules = self._get_rules(dir_path)
+            if rules is not None:
+                regex, negations = (rules.dir_regex, rules.dir_negations) if is_dir \
+                    else (rules.file_regex, rules.file_negations)
+                match = regex.fullmatch(path[len(dir_path) + 1:] if dir_path else path) \
+                    if regex is not None else None
+                if match is not None:
+                    return not negations[match.lastindex - 1]
+            if not dir_path:
+                return False
+            dir_path = os.path.dirname(dir_path)
+
+
+# yield the paths (relative to the cwd, which is the repo root) of the files
+# under start that aren't ignored. ignored dirs are removed from os.walk's
+# dirnames in place, so we never list what's inside them
+def iter_files(start: str = ".") -> Iterator[str]:
+    matcher = Matcher()
+    start = os.path.relpath(start)
+    if start != ".":
+        # start itself, or a dir above it, may be ignored
+        parts = start.split("/")
+        for end in range(1, len(parts) + 1):
+            if matcher.is_ignored("/".join(parts[:end]), is_dir=True):
+                return
+
+    for root, dir_names, file_names in os.walk(start):
+        prefix = "" if root == "." else os.path.normpath(root) + "/"
+        dir_names[:] = [
+            name for name in dir_names if not matcher.is_ignored(prefix + name, is_dir=True)
+        ]
+        for name in file_names:
+            if not matcher.is_ignored(prefix + name):
+                yield prefix + name
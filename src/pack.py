@@ -0,0 +1,372 @@
+# pack module handle the packfile format: many objects concatenated into one
+# .pack file, plus a sorted .idx file that map oid -> offset in the .pack.
+#
+# .pack layout:
+#   header: b"RPCK" | version (4 bytes) | object count (4 bytes)
+#   entries: kind (1 byte) | payload length (8 bytes) | payload
+#     kind 0: payload is zlib("type\0content"), the same bytes a loose object hash over
+#     kind 1: payload is the offset of the base entry in this pack (8 bytes)
+#             + zlib(delta), the delta (see delta.py) turns the base's
+#             "type\0content" into this object's. the base is always earlier
+#   the pack is named pack-<sha1 of the whole .pack file>
+#
+# .idx layout:
+#   header: b"RPIX" | version (4 bytes)
+#   fanout: 256 * 4 bytes, fanout[b] = number of oids whose first byte <= b
+#   oids: count * 20 bytes, sorted
+#   offsets: count * 8 bytes, offsets[i] is where oids[i] start in the .pack
+#   trailer: sha1 of the .pack (to pair them up)
+import os
+import mmap
+import zlib
+import struct
+import hashlib
+import tempfile
+import threading
+from collections import namedtuple, OrderedDict
+from typing import Dict, Iterable, Iterator, Tuple
+from src import delta
+
+PACK_MAGIC = b"RPCK"
+INDEX_MAGIC = b"RPIX"
+VERSION = 1
+
+KIND_FULL = 0
+KIND_DELTA = 1
+
+# delta search when repacking: each blob/tree is tried against this many of the
+# objects before it (sorted by type, path, size), and a chain of deltas never
+# gets longer than DELTA_DEPTH, so a read applies at most that many
+DELTA_WINDOW = 10
+DELTA_DEPTH = 50
+MIN_DELTA_SIZE = 64 # smaller objects aren't worth a delta
+# resolved objects we keep to apply the next delta in a chain on
+DELTA_BASE_CACHE_BYTES = 16 << 20
+
+_PACK_HEADER = struct.Struct(">4sII")
+_INDEX_HEADER = struct.Struct(">4sI")
+_ENTRY_HEADER = struct.Struct(">BQ")
+_FANOUT = struct.Struct(">256I")
+_OFFSET = struct.Struct(">Q")
+
+OID_SIZE = 20
+_FANOUT_START = _INDEX_HEADER.size
+_OIDS_START = _FANOUT_START + _FANOUT.size
+
+# a loaded pack, index and data are both memory-mapped
+Pack = namedtuple("Pack", ["name", "index", "data", "count"])
+
+
+def _map_file(path: str) -> mmap.mmap:
+    with open(path, "rb") as file:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+# map .pack and .idx of a pack and check their headers
+def load_pack(pack_dir: str, name: str) -> Pack:
+    index = _map_file(os.path.join(pack_dir, f"{name}.idx"))
+    data = _map_file(os.path.join(pack_dir, f"{name}.pack"))
+
+    magic, version = _INDEX_HEADER.unpack_from(index, 0)
+    assert magic == INDEX_MAGIC and version == VERSION, f"bad pack index {name}"
+    magic, version, count = _PACK_HEADER.unpack_from(data, 0)
+    assert magic == PACK_MAGIC and version == VERSION, f"bad pack {name}"
+
+    return Pack(name=name, index=index, data=data, count=count)
+
+
+# yield name of every complete pack (the ones that have .idx) in pack_dir
+def iter_pack_names(pack_dir: str) -> Iterator[str]:
+    if not os.path.isdir(pack_dir):
+        return
+    for filename in sorted(os.listdir(pack_dir)):
+        name, ext = os.path.splitext(filename)
+        if ext == ".idx" and os.path.isfile(os.path.join(pack_dir, f"{name}.pack")):
+            yield name
+
+
+def _oid_at(pack: Pack, i: int) -> bytes:
+    start = _OIDS_START + i * OID_SIZE
+    return pack.index[start:start + OID_SIZE]
+
+
+# binary search the oid in the index, return its position or -1
+def find_position(pack: Pack, oid: str) -> int:
+    try:
+        target = bytes.fromhex(oid)
+    except ValueError:
+        return -1
+    if len(target) != OID_SIZE:
+        return -1
+
+    # fanout narrow the search down to the oids with the same first byte
+    first = target[0]
+    lo = _fanout_at(pack, first - 1) if first > 0 else 0
+    hi = _fanout_at(pack, first)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        mid_oid = _oid_at(pack, mid)
+        if mid_oid < target:
+            lo = mid + 1
+        elif mid_oid > target:
+            hi = mid
+        else:
+            return mid
+    return -1
+
+
+def _fanout_at(pack: Pack, byte: int) -> int:
+    return struct.unpack_from(">I", pack.index, _FANOUT_START + byte * 4)[0]
+
+
+def _offset_at(pack: Pack, i: int) -> int:
+    start = _OIDS_START + pack.count * OID_SIZE + i * _OFFSET.size
+    return _OFFSET.unpack_from(pack.index, start)[0]
+
+
+def contains(pack: Pack, oid: str) -> bool:
+    return find_position(pack, oid) >= 0
+
+
+# return the raw object ("type\0content") stored for oid, None if not in this pack
+def read_object(pack: Pack, oid: str) -> bytes | None:
+    position = find_position(pack, oid)
+    if position < 0:
+        return None
+    return _read_entry(pack, _offset_at(pack, position))
+
+
+def _read_entry(pack: Pack, offset: int) -> bytes:
+    kind, length = _ENTRY_HEADER.unpack_from(pack.data, offset)
+    start = offset + _ENTRY_HEADER.size
+    if kind == KIND_FULL:
+        return zlib.decompress(pack.data[start:start + length])
+    assert kind == KIND_DELTA, f"unknown pack entry kind {kind}"
+    base_offset = _OFFSET.unpack_from(pack.data, start)[0]
+    delta_data = zlib.decompress(pack.data[start + _OFFSET.size:start + length])
+    return delta.apply(_read_base(pack, base_offset), delta_data)
+
+
+# an LRU of the objects we resolved as a delta base: objects of one file tend
+# to be read together (log -p, checkout of close commits), and they share the
+# start of their chain
+class _BaseCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: OrderedDict[Tuple[str, int], bytes] = OrderedDict()
+        self._lock = threading.Lock() # checkout reads objects from threads
+
+    def get(self, key: Tuple[str, int]) -> bytes | None:
+        with self._lock:
+            raw = self._entries.get(key)
+            if raw is not None:
+                self._entries.move_to_end(key)
+            return raw
+
+    def put(self, key: Tuple[str, int], raw: bytes) -> None:
+        if len(raw) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = raw
+            self.size += len(raw)
+            while self.size > self.max_bytes:
+                _, old_raw = self._entries.popitem(last=False)
+                self.size -= len(old_raw)
+
+
+_delta_bases = _BaseCache(DELTA_BASE_CACHE_BYTES)
+
+
+def _read_base(pack: Pack, offset: int) -> bytes:
+    key = (pack.name, offset)
+    raw = _delta_bases.get(key)
+    if raw is None:
+        raw = _read_entry(pack, offset)
+        _delta_bases.put(key, raw)
+    return raw
+
+
+# yield every oid in the pack that starts with a hex prefix (at least 2 chars):
+# binary search the first oid >= prefix, then walk while it still matches
+def iter_oids_with_prefix(pack: Pack, prefix: str) -> Iterator[str]:
+    lowest = bytes.fromhex(prefix.ljust(2 * OID_SIZE, "0"))
+    first = lowest[0]
+    lo = _fanout_at(pack, first - 1) if first > 0 else 0
+    hi = _fanout_at(pack, first)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if _oid_at(pack, mid) < lowest:
+            lo = mid + 1
+        else:
+            hi = mid
+    for i in range(lo, _fanout_at(pack, first)):
+        oid = _oid_at(pack, i).hex()
+        if not oid.startswith(prefix):
+            break
+        yield oid
+
+
+def oid_at(pack: Pack, position: int) -> str:
+    return _oid_at(pack, position).hex()
+
+
+def iter_oids(pack: Pack) -> Iterator[str]:
+    for i in range(pack.count):
+        yield _oid_at(pack, i).hex()
+
+
+# receive (oid, raw object) pairs, write .pack then .idx into pack_dir
+# and return the pack name. The .idx is renamed in last, so a reader
+# never see a pack that is half written.
+# with window > 0 (repack) we look for deltas between similar blobs and trees,
+# paths (oid -> a path it is at) put the versions of one file next to each other.
+# durable: fsync both files before they get their names, then the dir
+def write_pack(
+    pack_dir: str,
+    objects: Iterable[Tuple[str, bytes]],
+    window: int = 0,
+    paths: Dict[str, str] | None = None,
+    durable: bool = False
+) -> str:
+    os.makedirs(pack_dir, exist_ok=True)
+    temp_pack_path = _make_temp_file(pack_dir, "tmp-pack-")
+    temp_index_path = temp_pack_path.replace("tmp-pack-", "tmp-idx-")
+
+    entries = _write_full_entries(temp_pack_path, objects)
+    if window > 0:
+        offsets = _write_delta_entries(temp_pack_path, entries, window, paths or {})
+    else:
+        offsets = [(entry.oid, entry.offset) for entry in entries]
+
+    hasher = hashlib.sha1()
+    with open(temp_pack_path, "rb") as pack_file:
+        for chunk in iter(lambda: pack_file.read(1 << 20), b""):
+            hasher.update(chunk)
+    checksum = hasher.digest()
+    name = f"pack-{checksum.hex()}"
+
+    offsets.sort()
+    fanout = [0] * 256
+    for binary_oid, _ in offsets:
+        fanout[binary_oid[0]] += 1
+    for byte in range(1, 256):
+        fanout[byte] += fanout[byte - 1]
+
+    with open(temp_index_path, "wb") as index_file:
+        index_file.write(_INDEX_HEADER.pack(INDEX_MAGIC, VERSION))
+        index_file.write(_FANOUT.pack(*fanout))
+        index_file.write(b"".join(binary_oid for binary_oid, _ in offsets))
+        index_file.write(b"".join(_OFFSET.pack(offset) for _, offset in offsets))
+        index_file.write(checksum)
+
+    if durable:
+        _fsync(temp_pack_path)
+        _fsync(temp_index_path)
+    os.replace(temp_pack_path, os.path.join(pack_dir, f"{name}.pack"))
+    os.replace(temp_index_path, os.path.join(pack_dir, f"{name}.idx"))
+    if durable:
+        _fsync(pack_dir)
+    return name
+
+
+def _fsync(path: str) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# unique temp names, two packs can be written at once (e.g. two pushes)
+def _make_temp_file(pack_dir: str, prefix: str) -> str:
+    fd, path = tempfile.mkstemp(dir=pack_dir, prefix=prefix)
+    os.close(fd)
+    return path
+
+
+# an object we wrote in full: binary oid, where it starts, type, raw size
+_Entry = namedtuple("_Entry", ["oid", "offset", "type", "size"])
+
+
+def _write_full_entries(pack_path: str, objects: Iterable[Tuple[str, bytes]]) -> list[_Entry]:
+    entries = []
+    seen = set()
+    with open(pack_path, "wb") as pack_file:
+        # write a placeholder header first, the count is known only at the end
+        pack_file.write(_PACK_HEADER.pack(PACK_MAGIC, VERSION, 0))
+        offset = _PACK_HEADER.size
+        for oid, raw in objects:
+            if oid in seen: continue
+            seen.add(oid)
+            payload = zlib.compress(raw)
+            entry = _ENTRY_HEADER.pack(KIND_FULL, len(payload)) + payload
+            pack_file.write(entry)
+            type_ = raw[:raw.index(b"\0")].decode()
+            entries.append(_Entry(oid=bytes.fromhex(oid), offset=offset, type=type_, size=len(raw)))
+            offset += len(entry)
+
+        pack_file.seek(0)
+        pack_file.write(_PACK_HEADER.pack(PACK_MAGIC, VERSION, len(entries)))
+    return entries
+
+
+def _is_delta_candidate(entry: _Entry) -> bool:
+    return entry.type in ("blob", "tree") and entry.size >= MIN_DELTA_SIZE
+
+
+# write the pack at pack_path again, with deltas. blobs and trees are sorted by
+# (type, file name, path, biggest first), so a new version of a file comes
+# right after the older ones, and each one becomes a delta against the one of
+# the last window objects that gives the smallest delta (if it saves at least
+# half). entries without a delta are copied as they are, not compressed again.
+# return (binary oid, offset) of every entry
+def _write_delta_entries(
+    pack_path: str,
+    entries: list[_Entry],
+    window: int,
+    paths: Dict[str, str]
+) -> list[Tuple[bytes, int]]:
+    def sort_key(entry: _Entry) -> Tuple[bool, str, str, str, int, bytes]:
+        path = paths.get(entry.oid.hex(), "")
+        # the oid last, so the same objects always make the same pack
+        return (_is_delta_candidate(entry), entry.type, os.path.basename(path), path, -entry.size, entry.oid)
+
+    out_path = _make_temp_file(os.path.dirname(pack_path), "tmp-pack-")
+    offsets = []
+    # the last window candidates: (delta index, offset in the new pack, chain depth, type)
+    recent: list[Tuple[delta.Index, int, int, str]] = []
+    with open(pack_path, "rb") as source_file, open(out_path, "wb") as out_file:
+        source = mmap.mmap(source_file.fileno(), 0, access=mmap.ACCESS_READ)
+        out_file.write(source[:_PACK_HEADER.size])
+        offset = _PACK_HEADER.size
+        for entry in sorted(entries, key=sort_key):
+            _, length = _ENTRY_HEADER.unpack_from(source, entry.offset)
+            end = entry.offset + _ENTRY_HEADER.size + length
+            written = source[entry.offset:end]
+
+            if _is_delta_candidate(entry):
+                raw = zlib.decompress(source[entry.offset + _ENTRY_HEADER.size:end])
+                best, best_offset, depth = None, 0, 0
+                for base_index, base_offset, base_depth, base_type in recent:
+                    if base_type != entry.type or base_depth >= DELTA_DEPTH:
+                        continue
+                    max_size = len(best) - 1 if best is not None else entry.size // 2
+                    found = delta.create(base_index, raw, max_size)
+                    if found is not None:
+                        best, best_offset, depth = found, base_offset, base_depth + 1
+                if best is not None:
+                    payload = _OFFSET.pack(best_offset) + zlib.compress(best)
+                    written = _ENTRY_HEADER.pack(KIND_DELTA, len(payload)) + payload
+                recent.append((delta.create_index(raw), offset, depth, entry.type))
+                if len(recent) > window:
+                    recent.pop(0)
+
+            out_file.write(written)
+            offsets.append((entry.oid, offset))
+            offset += len(written)
+        source.close()
+    os.replace(out_path, pack_path)
+    return offsets
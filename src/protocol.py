@@ -0,0 +1,274 @@
+# protocol module is the network side of fetch/push: a small framed protocol
+# over TCP spoken by `rgit daemon` (daemon.py) and the client functions here,
+# used for remotes like rgit://host:port/path/to/repo.
+#
+# every frame is: payload length (4 bytes) | kind (1 byte) | payload
+# a connection carries one command, the first frame is COMMAND "<name> <repo path>"
+#
+#   fetch:   server: REF* DONE          (ref advertisement: "<oid> <ref>")
+#            client: DEPTH? FILTER? WANT* HAVE* DONE (tips it wants, tips it has,
+#                    FILTER "blob:none": send no blobs)
+#            server: SHALLOW* COUNT OBJECT* DONE (everything between wants and
+#                    haves, SHALLOW: the cut points of it, see fetch --depth)
+#   push:    server: REF* DONE
+#            client: UPDATE ("<old oid> <new oid> <ref>") COUNT OBJECT* DONE
+#            server: OK or ERROR
+#   objects: client: WANT* DONE, the server answers each WANT with an OBJECT as
+#            soon as it reads it, so the client sends every request up front
+#            (pipelined) instead of waiting for each object
+#
+# an OBJECT payload is the binary oid (20 bytes) + zlib("type\0content").
+# either side can send ERROR with a message instead of the next frame
+import os
+import zlib
+import struct
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Coroutine, Dict, Iterable, Set, Tuple
+from urllib.parse import urlsplit
+from src import data, base
+
+SCHEME = "rgit"
+DEFAULT_PORT = 9419
+OID_SIZE = 20
+
+_FRAME_HEADER = struct.Struct(">IB")
+_COUNT = struct.Struct(">Q")
+
+COMMAND = b"C"
+REF = b"R"
+WANT = b"W"
+HAVE = b"H"
+DONE = b"D"
+COUNT = b"N"
+OBJECT = b"O"
+UPDATE = b"U"
+OK = b"K"
+ERROR = b"E"
+DEPTH = b"P"
+SHALLOW = b"S"
+FILTER = b"F"
+
+# how much we buffer before waiting for the other side to read
+WRITE_BUFFER_LIMIT = 1 << 20
+
+
+def is_url(remote: str) -> bool:
+    return remote.startswith(f"{SCHEME}://")
+
+
+# rgit://host:port/path -> (host, port, path)
+def parse_url(url: str) -> Tuple[str, int, str]:
+    parts = urlsplit(url)
+    if parts.scheme != SCHEME or not parts.hostname:
+        raise ValueError(f"not an rgit url: {url}")
+    return (parts.hostname, parts.port or DEFAULT_PORT, parts.path.lstrip("/") or ".")
+
+
+def write_frame(writer: asyncio.StreamWriter, kind: bytes, payload: bytes = b"") -> None:
+    writer.write(_FRAME_HEADER.pack(len(payload), kind[0]) + payload)
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Tuple[bytes, bytes]:
+    length, kind = _FRAME_HEADER.unpack(await reader.readexactly(_FRAME_HEADER.size))
+    payload = await reader.readexactly(length)
+    if bytes([kind]) == ERROR:
+        raise ConnectionError(f"remote error: {payload.decode()}")
+    return (bytes([kind]), payload)
+
+
+# read a frame and make sure it's the kind we expect
+async def expect_frame(reader: asyncio.StreamReader, *kinds: bytes) -> Tuple[bytes, bytes]:
+    kind, payload = await read_frame(reader)
+    if kind not in kinds:
+        raise ConnectionError(f"unexpected frame {kind!r}, expected {kinds}")
+    return (kind, payload)
+
+
+async def drain(writer: asyncio.StreamWriter) -> None:
+    if writer.transport.get_write_buffer_size() > WRITE_BUFFER_LIMIT:
+        await writer.drain()
+
+
+def write_object(writer: asyncio.StreamWriter, oid: str) -> None:
+    raw = data.get_raw_object(oid)
+    write_frame(writer, OBJECT, bytes.fromhex(oid) + zlib.compress(raw, data.LOOSE_COMPRESSION_LEVEL))
+
+
+def parse_object(payload: bytes) -> Tuple[str, bytes]:
+    return (payload[:OID_SIZE].hex(), zlib.decompress(payload[OID_SIZE:]))
+
+
+# send COUNT OBJECT* DONE, objects are read from the repo at repo_path.
+# nothing awaits inside switch_rgit_dir, so other connections of the daemon
+# (same thread) never run while we are switched
+async def send_objects(writer: asyncio.StreamWriter, repo_path: str, oids: list[str]) -> None:
+    with data.switch_rgit_dir(repo_path):
+        data.fetch_promised_objects(oids) # a partial clone gets them all first
+    write_frame(writer, COUNT, _COUNT.pack(len(oids)))
+    for oid in oids:
+        with data.switch_rgit_dir(repo_path):
+            write_object(writer, oid)
+        await drain(writer)
+    write_frame(writer, DONE)
+    await writer.drain()
+
+
+# read COUNT OBJECT* DONE into the repo at repo_path, return the object count.
+# pass the COUNT payload if the caller already read that frame
+async def receive_objects(reader: asyncio.StreamReader, repo_path: str, count_payload: bytes = b"") -> int:
+    if not count_payload:
+        _, count_payload = await expect_frame(reader, COUNT)
+    count = _COUNT.unpack(count_payload)[0]
+    with data.switch_rgit_dir(repo_path):
+        receiver = data.ObjectReceiver(count)
+    try:
+        for _ in range(count):
+            _, payload = await expect_frame(reader, OBJECT)
+            receiver.add(*parse_object(payload))
+        await expect_frame(reader, DONE)
+    finally:
+        receiver.close()
+    return count
+
+
+def write_refs(writer: asyncio.StreamWriter, refs: Dict[str, data.RefValue]) -> None:
+    for ref, ref_value in refs.items():
+        write_frame(writer, REF, f"{ref_value.value} {ref}".encode())
+    write_frame(writer, DONE)
+
+
+async def read_refs(reader: asyncio.StreamReader) -> Dict[str, data.RefValue]:
+    refs: Dict[str, data.RefValue] = {}
+    while True:
+        kind, payload = await expect_frame(reader, REF, DONE)
+        if kind == DONE:
+            return refs
+        oid, ref = payload.decode().split(" ", 1)
+        refs[ref] = data.RefValue(symbolic=False, value=oid)
+
+
+async def _connect(url: str, command: str) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    host, port, path = parse_url(url)
+    reader, writer = await asyncio.open_connection(host, port)
+    write_frame(writer, COMMAND, f"{command} {path}".encode())
+    return (reader, writer)
+
+
+async def _close(writer: asyncio.StreamWriter) -> None:
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except ConnectionError:
+        pass
+
+
+# fetch every branch of the remote into the current repo (only depth commits
+# of each with depth), return its refs and the cut points of what we got
+def fetch(
+    url: str,
+    depth: int | None = None,
+    filter_spec: str | None = None
+) -> Tuple[Dict[str, data.RefValue], Set[str]]:
+    return asyncio.run(_fetch(url, depth, filter_spec))
+
+
+async def _fetch(url: str, depth: int | None, filter_spec: str | None) -> Tuple[Dict[str, data.RefValue], Set[str]]:
+    reader, writer = await _connect(url, "fetch")
+    cut = set()
+    try:
+        remote_refs = await read_refs(reader)
+        if depth is not None:
+            write_frame(writer, DEPTH, str(depth).encode())
+        if filter_spec is not None:
+            write_frame(writer, FILTER, filter_spec.encode())
+        wants = {ref_value.value for ref_value in remote_refs.values() if ref_value.value}
+        for oid in wants:
+            # we may have a tip but not depth commits below it
+            if depth is not None or not data.object_exists(oid):
+                write_frame(writer, WANT, oid.encode())
+        # our tips, the server stops its walk at the ones it knows
+        for _, ref_value in data.iter_refs(deref=True):
+            if ref_value.value:
+                write_frame(writer, HAVE, ref_value.value.encode())
+        write_frame(writer, DONE)
+        await writer.drain()
+        while True:
+            kind, payload = await expect_frame(reader, SHALLOW, COUNT)
+            if kind == COUNT:
+                break
+            cut.add(payload.decode())
+        await receive_objects(reader, ".", payload)
+    finally:
+        await _close(writer)
+    return (remote_refs, cut)
+
+
+# push branch to the remote, return False if the remote branch isn't an
+# ancestor of ours (we never force push)
+def push(url: str, branch_name: str) -> bool:
+    return asyncio.run(_push(url, branch_name))
+
+
+async def _push(url: str, branch_name: str) -> bool:
+    target_oid = base.get_oid(branch_name)
+    branch_path = os.path.join("refs", "heads", branch_name)
+    reader, writer = await _connect(url, "push")
+    try:
+        remote_refs = await read_refs(reader)
+        old_oid = remote_refs[branch_path].value if branch_path in remote_refs else ""
+        if old_oid and not base.is_ancestor(old_oid=old_oid, new_oid=target_oid):
+            return False
+
+        common_tips = {ref_value.value for ref_value in remote_refs.values()
+            if ref_value.value and data.object_exists(ref_value.value)}
+        new_objects = list(base.iter_objects_in_commits({target_oid}, exclude=common_tips))
+
+        write_frame(writer, UPDATE, f"{old_oid or '-'} {target_oid} {branch_path}".encode())
+        await send_objects(writer, ".", new_objects)
+        await expect_frame(reader, OK)
+    finally:
+        await _close(writer)
+    return True
+
+
+# fetch single objects by oid (e.g. blobs a partial clone skipped). every
+# request is sent before we read the first answer
+def fetch_objects(url: str, oids: Iterable[str]) -> None:
+    _run(_fetch_objects(url, list(oids)))
+
+
+# asyncio.run, but on a thread of its own if this thread already runs an event
+# loop (the daemon serving a partial clone). that loop waits for it, so the
+# current RGIT_DIR doesn't change meanwhile
+def _run(coroutine: Coroutine[Any, Any, None]) -> None:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        asyncio.run(coroutine)
+        return
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        executor.submit(asyncio.run, coroutine).result()
+
+
+async def _fetch_objects(url: str, oids: list[str]) -> None:
+    reader, writer = await _connect(url, "objects")
+    receiver = data.ObjectReceiver(len(oids))
+
+    async def send_requests() -> None:
+        for oid in oids:
+            write_frame(writer, WANT, oid.encode())
+            await drain(writer)
+        write_frame(writer, DONE)
+        await writer.drain()
+
+    try:
+        sending = asyncio.create_task(send_requests())
+        for _ in oids:
+            _, payload = await expect_frame(reader, OBJECT)
+            receiver.add(*parse_object(payload))
+        await expect_frame(reader, DONE)
+        await sending
+    finally:
+        receiver.close()
+        await _close(writer)
@@ -1,10 +1,11 @@
 import os
-from src import data, base
+from src import data, base, protocol
 from typing import Dict
 
 
 REMOTE_REFS_BASE = os.path.join("refs", "heads") # remote store in refs/heads/
 LOCAL_REFS_BASE = os.path.join("refs", "remote") # we will change to store here
+FILTER_SPECS = ("blob:none",) # what fetch --filter takes
 
 
 def _get_remote_refs(remote_path: str) -> Dict[str, data.RefValue]:
@@ -12,34 +13,54 @@ def _get_remote_refs(remote_path: str) -> Dict[str, data.RefValue]:
         return {ref: ref_val for ref, ref_val in data.iter_refs(prefix="heads")}
 
 
-def fetch(remote_path: str) -> None:
+# the commits at the tip of every ref we have, what we tell the other side we have
+def _get_local_tips() -> set[str]:
+    return {ref_val.value for _, ref_val in data.iter_refs(deref=True) if ref_val.value}
+
+
+# negotiation: we send the remote our tips (haves), it keeps the ones it knows
+# and only lists the objects between its branches (wants) and those.
+# with depth, we only get the last depth commits of each branch, and remember
+# where the history stops in the shallow file.
+# with filter_spec "blob:none" we get no blobs, the remote becomes our promisor
+# and blobs are fetched from it when we need them
+def fetch(remote_path: str, depth: int | None = None, filter_spec: str | None = None) -> None:
+    if filter_spec is not None and filter_spec not in FILTER_SPECS:
+        raise ValueError(f"unknown filter {filter_spec}, we only know {', '.join(FILTER_SPECS)}")
+    blobs = filter_spec is None
+    if not blobs:
+        data.set_promisor(remote_path if protocol.is_url(remote_path) else os.path.abspath(remote_path))
+
+    if protocol.is_url(remote_path):
+        remote_refs, cut = protocol.fetch(remote_path, depth, filter_spec)
+        base.update_shallow(cut)
+        _set_remote_refs(remote_refs)
+        return
+
     remote_refs = _get_remote_refs(remote_path) # fetch the refs
-    ref_vals = set() # want to use this when fetch objects
+    ref_vals = {ref_val.value for ref_val in remote_refs.values()
+        if not ref_val.symbolic and ref_val.value}
+    local_tips = _get_local_tips()
+
+    with data.switch_rgit_dir(remote_path):
+        common_tips = {oid for oid in local_tips if data.object_exists(oid)}
+        missing_objects = list(base.iter_objects_in_commits(
+            ref_vals, exclude=common_tips, depth=depth, blobs=blobs))
+        cut = base.get_shallow_cut(ref_vals, missing_objects, depth)
+
+    data.copy_objects(remote_path, ".", missing_objects)
+    # before the refs, so nothing ever points at history we don't have
+    base.update_shallow(cut)
+
+    # set the remote refs to our local repo, now that we have their objects
+    _set_remote_refs(remote_refs)
+
 
-    # set the remote refs to our local repo
+def _set_remote_refs(remote_refs: Dict[str, data.RefValue]) -> None:
     for ref, ref_val in remote_refs.items():
         branch_name = os.path.relpath(ref, REMOTE_REFS_BASE)
         target_path = os.path.join(LOCAL_REFS_BASE, branch_name)
         data.update_ref(target_path, ref_val, deref=False)
-        if not ref_val.symbolic:
-            ref_vals.add(ref_val.value)
-
-    for oid in base.iter_objects_in_commits(ref_vals):
-        data.fetch_object_if_missing(remote_path, oid)
-
-def _get_remote_objects(remote_path: str) -> set[str]:
-    refs_dict = _get_remote_refs(remote_path)
-    refvals_set = set()
-    for ref_val in refs_dict.values():
-        if ref_val.symbolic or not data.object_exists(ref_val.value):
-            continue
-        refvals_set.add(ref_val.value)
-
-    objects = set()
-    with data.switch_rgit_dir(remote_path):
-       for oid in base.iter_objects_in_commits(refvals_set):
-           objects.add(oid)
-    return objects
 
 
 # only 2 cases we can push:
@@ -60,18 +81,24 @@ def can_push(remote_path: str, branch_name: str) -> bool:
 
 
 def push(remote_path: str, branch_name: str) -> None:
+    if protocol.is_url(remote_path):
+        if not protocol.push(remote_path, branch_name):
+            print("cannot force push the repo")
+        return
+
     if not can_push(remote_path, branch_name):
         print("cannot force push the repo")
         return
 
     target_oid = base.get_oid(branch_name)
 
-    remote_objects = _get_remote_objects(remote_path)
-    pushed_objects = {oid for oid in base.iter_objects_in_commits({target_oid})}
-    needed_objects = pushed_objects.difference(remote_objects)
+    # the remote tips we also have are where our walk can stop
+    remote_refs = _get_remote_refs(remote_path)
+    common_tips = {ref_val.value for ref_val in remote_refs.values()
+        if not ref_val.symbolic and ref_val.value and data.object_exists(ref_val.value)}
 
-    for oid in needed_objects:
-        data.push_object(remote_path, oid)
+    new_objects = base.iter_objects_in_commits({target_oid}, exclude=common_tips)
+    data.copy_objects(".", remote_path, new_objects)
 
     # update the branch ref in remote repo to point to our latest commit
     with data.switch_rgit_dir(remote_path):